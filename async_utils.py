@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+"""
+Event loop helpers for the --async crawlers.
+"""
+
+import asyncio, functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class EndpointLimiter(object):
+    """Run blocking calls off the event loop with at most limits[endpoint]
+    of them in flight per endpoint (e.g. QC server, ES, Mozart)."""
+
+    def __init__(self, limits):
+        self.semaphores = dict([(e, asyncio.Semaphore(n)) for e, n in limits.items()])
+        self.executor = ThreadPoolExecutor(max_workers=sum(limits.values()))
+
+    async def run(self, endpoint, func, *args, **kwargs):
+        """Return result of func(*args, **kwargs) once endpoint has a free slot."""
+
+        async with self.semaphores[endpoint]:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor,
+                                              functools.partial(func, *args, **kwargs))
+
+    async def map(self, endpoint, func, items):
+        """Return list of func(item) for items, run concurrently, in order."""
+
+        return await asyncio.gather(*[self.run(endpoint, func, i) for i in items])
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def chunks(items, size):
+    """Return list of consecutive slices of items of at most size."""
+
+    return [items[i:i+size] for i in range(0, len(items), max(1, size))]
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Submit Sentinel-1 QC backfill jobs, one per shard of a date range.
+"""
+
+from __future__ import print_function
+
+import argparse
+
+from cron_crawler import submit_crawler_job
+from qc_filenames import format_time, parse_query_time
+
+
+def get_shards(start, end, shard_days=30):
+    """Return list of (start, end) epoch seconds of at most shard_days days
+    covering [start, end)."""
+
+    shards = []
+    shard_start = start
+    while shard_start < end:
+        shard_end = min(shard_start + shard_days * 86400, end)
+        shards.append((shard_start, shard_end))
+        shard_start = shard_end
+    return shards
+
+
+if __name__ == "__main__":
+    '''
+    Main program that submits a Sentinel-1 QC backfill job per shard
+    '''
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("ds_es_url", help="ElasticSearch URL for datasets, e.g. " +
+                        "http://aria-products.jpl.nasa.gov:9200")
+    parser.add_argument("--start", help="start of the backfill date range, e.g. 2017-01-01",
+                        required=True)
+    parser.add_argument("--end", help="end (exclusive) of the backfill date range",
+                        required=True)
+    parser.add_argument("--shard_days", help="number of days to backfill per job",
+                        type=int, default=30, required=False)
+    parser.add_argument("--types", help="comma-separated product types to backfill",
+                        default="orbit,calibration", required=False)
+    parser.add_argument("--dataset_version", help="dataset version",
+                        default="v1.1", required=False)
+    parser.add_argument("--tag", help="PGE docker image tag (release, version, " +
+                                      "or branch) to propagate",
+                        default="master", required=False)
+    parser.add_argument("--dry_run", help="print shards without submitting jobs",
+                        action="store_true", default=False)
+    args = parser.parse_args()
+
+    job_spec = "job-s1_qc_backfill:%s" % args.tag
+    shards = get_shards(parse_query_time(args.start), parse_query_time(args.end),
+                        args.shard_days)
+    for shard_start, shard_end in shards:
+        start, end = format_time(shard_start), format_time(shard_end)
+        job_name = "%s-%s-%s" % (job_spec.lstrip('job-'), start, end)
+        params = [
+            ("version_opt", "--dataset_version"),
+            ("version", args.dataset_version),
+            ("tag_opt", "--tag"),
+            ("tag", args.tag),
+            ("types_opt", "--types"),
+            ("types", args.types),
+            ("start_opt", "--start"),
+            ("start", start),
+            ("end_opt", "--end"),
+            ("end", end),
+            ("es_dataset_url", args.ds_es_url),
+        ]
+        print("%s %s backfill job for %s to %s" % ("would submit" if args.dry_run
+                                                   else "submitting", args.types, start, end))
+        if not args.dry_run: submit_crawler_job(job_spec, params, job_name)
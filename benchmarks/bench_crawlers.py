@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+"""
+Benchmark the crawlers and dataset creators end-to-end against local
+stand-ins for the QC server, GRQ ES and Mozart.
+"""
+
+import os, sys, json, time, types, shutil, tempfile, argparse, resource, threading, zlib
+import asyncio, hashlib, functools
+import multiprocessing
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+from bench_listing_parser import synthetic_listing
+
+
+SCENARIOS = ['crawl_orbits', 'crawl_orbits_async', 'crawl_cals', 'crawl_cals_async',
+             'crawl_all', 'create_orbit_ds', 'create_orbit_ds_batch', 'create_cal_ds',
+             'create_cal_ds_batch']
+
+# variants that must produce exactly what the scenario without the suffix does
+VARIANT_SUFFIXES = ['_async', '_batch']
+
+# pool processes of the batch create scenarios
+BATCH_WORKERS = 4
+
+# calibration listing pages are capped at 100 by crawl_cals
+CAL_PAGE_LIMIT = 99
+
+
+def cal_names(count):
+    """Return list of count synthetic calibration file names."""
+
+    start = datetime(2014, 4, 3)
+    fmt = "%Y%m%dT%H%M%S"
+    names = []
+    for i in range(count):
+        vs = start + timedelta(minutes=i)
+        names.append("S1%s_AUX_CAL_V%s_G%s" % ("AB"[i % 2], vs.strftime(fmt),
+                                               (vs + timedelta(days=30)).strftime(fmt)))
+    return names
+
+
+def cal_page(names, page, pages):
+    """Return bytes of a paginated AUX_CAL listing page."""
+
+    rows = ['<tr><td><a href="/aux_cal/%s/">%s</a></td></tr>' % (n, n) for n in names]
+    items = ['<li><a href="?page=%d">%d</a></li>' % (i, i) for i in range(1, pages + 1)]
+    return ('<html><body><table>%s</table><ul class="pagination"><li>&laquo;</li>%s'
+            '<li>&raquo;</li></ul></body></html>' % ("".join(rows), "".join(items))).encode('utf-8')
+
+
+def is_ingested(id, present_pct):
+    """Deterministically decide whether the fake ES holds id."""
+
+    return zlib.crc32(id.encode('utf-8')) % 100 < present_pct
+
+
+class StandIn(object):
+    """Local QC server, ES and data server in one threaded HTTP server."""
+
+    def __init__(self, count, present_pct, payload_size):
+        self.count = count
+        self.present_pct = present_pct
+        self.payload = b'\0' * payload_size
+        self.listings = {
+            '/aux_poeorb': synthetic_listing(count, "POEORB"),
+            '/aux_resorb': synthetic_listing(count, "RESORB"),
+        }
+        names = cal_names(count)
+        self.page_size = max(50, -(-count // CAL_PAGE_LIMIT))
+        self.cal_pages = [names[i:i+self.page_size] for i in range(0, len(names), self.page_size)]
+        self.lock = threading.Lock()
+        self.requests = {}
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args): pass
+
+            def reply(self, kind, body, content_type='text/html'):
+                standin.count_request(kind)
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path in standin.listings:
+                    self.reply('listing', standin.listings[url.path])
+                elif url.path.startswith('/AUX_CAL/'):
+                    pages = len(standin.cal_pages)
+                    page = int(parse_qs(url.query).get('page', ['1'])[0])
+                    # like the QC server, pages past the end repeat the last page
+                    names = standin.cal_pages[min(page, pages) - 1]
+                    self.reply('listing', cal_page(names, page, pages))
+                elif url.path.startswith('/product/'):
+                    self.reply('download', standin.payload, 'application/octet-stream')
+                else:
+                    standin.count_request('not_found')
+                    self.send_error(404)
+
+            def do_POST(self):
+                if not self.path.endswith('/_search'):
+                    standin.count_request('not_found')
+                    return self.send_error(404)
+                query = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                hits = []
+                if not self.path.startswith('/grq_'):
+                    for must in query['query']['bool']['must']:
+                        ids = must.get('terms', must.get('term', {})).get('_id', [])
+                        if not isinstance(ids, list): ids = [ids]
+                        hits.extend([{'_id': id} for id in ids
+                                     if is_ingested(id, standin.present_pct)])
+                body = {'hits': {'total': len(hits), 'hits': hits}}
+                self.reply('es', json.dumps(body).encode('utf-8'), 'application/json')
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def count_request(self, kind):
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+
+    def reset(self):
+        with self.lock:
+            counts, self.requests = self.requests, {}
+        return counts
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def install_stand_ins():
+    """Provide Mozart/osaka stand-ins for modules not installed locally."""
+
+    import requests
+    def get(url, path):
+        r = requests.get(url, stream=True)
+        r.raise_for_status()
+        with open(path, 'wb') as f:
+            for chunk in r.iter_content(1 << 20): f.write(chunk)
+    stubs = {
+        'hysds': {}, 'hysds.celery': {'app': None},
+        'hysds_commons': {}, 'hysds_commons.job_utils': {'submit_mozart_job': None},
+        'osaka': {}, 'osaka.main': {'get': get, 'rmall': lambda url: None},
+    }
+    for name, attrs in stubs.items():
+        try: __import__(name)
+        except ImportError:
+            mod = types.ModuleType(name)
+            mod.__dict__.update(attrs)
+            sys.modules[name] = mod
+
+
+def run_scenario(scenario, count, server_url, work_dir, conn):
+    """Run scenario in this (child) process and send back its results."""
+
+    os.chdir(work_dir)
+    sys.stdout = sys.stderr = open(os.path.join(work_dir, 'bench.log'), 'w')
+    install_stand_ins()
+    import crawl_orbits, crawl_cals, crawl_all, create_orbit_ds, create_cal_ds
+    from dataset_utils import create_datasets, expand_inputs
+    from metrics import metrics
+    submitted = []
+    crawl_orbits.submit_mozart_job = lambda *args, **kwargs: submitted.append(kwargs['job_name'])
+    crawl_orbits.QC_SERVER = crawl_orbits.DATA_SERVER = server_url
+    crawl_cals.QC_SERVER = crawl_cals.DATA_SERVER = server_url
+    es_url = server_url.rstrip('/')
+
+    if scenario.startswith('create_'):
+        if scenario.startswith('create_orbit_ds'):
+            files = [l.split('"')[1] for l in synthetic_listing(count).decode('utf-8').split('\n')
+                     if l.startswith('<a href="S1')]
+            create = create_orbit_ds.create_orbit_ds
+            check = create_orbit_ds.check_orbits
+        else:
+            files = ["%s.SAFE" % n for n in cal_names(count)]
+            create = create_cal_ds.create_cal_ds
+            check = create_cal_ds.check_cals
+        in_dir = os.path.join(work_dir, 'inputs')
+        os.makedirs(in_dir)
+        for f in files:
+            with open(os.path.join(in_dir, f), 'wb') as fh: fh.write(b'\0' * 1024)
+
+    t0 = time.time()
+    if scenario == 'crawl_orbits':
+        crawl_orbits.crawl(es_url, "v1.1", "bench", "1", full_resync=True, quiet=True)
+    elif scenario == 'crawl_orbits_async':
+        asyncio.run(crawl_orbits.crawl_async(es_url, "v1.1", "bench", "1", full_resync=True,
+                                             quiet=True))
+    elif scenario == 'crawl_cals':
+        crawl_cals.crawl(es_url, "v1.1", "bench")
+    elif scenario == 'crawl_cals_async':
+        asyncio.run(crawl_cals.crawl_async(es_url, "v1.1", "bench"))
+    elif scenario == 'crawl_all':
+        sys.argv = ['crawl_all.py', es_url, '--tag', 'bench', '--state_file', '',
+                    '--full_resync', '--no_listing_cache', '--no_id_catalog', '--no_snapshots',
+                    '--quiet']
+        results = crawl_all.crawl(crawl_all.cmdLineParse())
+        if any([r['status'] != 'ok' for r in results.values()]):
+            raise RuntimeError("crawl_all failed: %s" % results)
+    elif scenario.endswith('_batch'):
+        create_datasets(expand_inputs([in_dir], lambda f: True), "v1.1",
+                        lambda ids: check(es_url, "grq", ids),
+                        functools.partial(create, ds_es_url=es_url, version="v1.1", dedup=False),
+                        BATCH_WORKERS)
+    else:
+        for f in files: create(os.path.join(in_dir, f), es_url, "v1.1")
+    wall = time.time() - t0
+
+    # digest of what the run produced, to compare sync and async variants
+    outputs = {'jobs': sorted(submitted), 'datasets': []}
+    for root, dirs, names in os.walk(work_dir):
+        for name in sorted(names):
+            if name.endswith('.met.json'):
+                with open(os.path.join(root, name)) as f: met = json.load(f)
+                met.pop('creationTime', None)
+                outputs['datasets'].append(met)
+    outputs['datasets'].sort(key=lambda met: met['data_product_name'])
+    digest = hashlib.sha1(json.dumps(outputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+    conn.send({
+        'wall_seconds': wall,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+        'jobs_submitted': len(submitted),
+        'output_digest': digest,
+        'metrics': metrics.as_dict(),
+    })
+    conn.close()
+
+
+def bench(scenario, count, standin):
+    """Run scenario at scale count in a fresh process. Return result dict."""
+
+    work_dir = tempfile.mkdtemp(prefix='bench_%s_' % scenario)
+    standin.reset()
+    ctx = multiprocessing.get_context('fork')
+    parent_conn, child_conn = ctx.Pipe(False)
+    p = ctx.Process(target=run_scenario, args=(scenario, count, standin.url, work_dir, child_conn))
+    p.start()
+    result = parent_conn.recv() if parent_conn.poll(None) else None
+    p.join()
+    shutil.rmtree(work_dir, ignore_errors=True)
+    if p.exitcode != 0 or result is None:
+        raise RuntimeError("Scenario %s at %d files failed." % (scenario, count))
+    result.update({'scenario': scenario, 'count': count, 'requests': standin.reset()})
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scales", help="comma-separated numbers of files per listing",
+                        default="100,1000,10000")
+    parser.add_argument("--scenarios", help="comma-separated scenarios to run",
+                        default=",".join(SCENARIOS))
+    parser.add_argument("--present_pct", help="percentage of IDs already ingested in ES",
+                        type=int, default=50)
+    parser.add_argument("--payload_size", help="size in bytes of downloaded files",
+                        type=int, default=1024)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    results = []
+    print("%-21s %8s %10s %10s %8s %8s %8s %8s" % ("scenario", "files", "wall (s)", "rss (MiB)",
+                                                  "listing", "es", "download", "jobs"))
+    for count in [int(c) for c in args.scales.split(',')]:
+        standin = StandIn(count, args.present_pct, args.payload_size)
+        try:
+            for scenario in args.scenarios.split(','):
+                if scenario not in SCENARIOS: parser.error("unknown scenario %s" % scenario)
+                r = bench(scenario, count, standin)
+                results.append(r)
+                print("%-21s %8d %10.2f %10.1f %8d %8d %8d %8d" % (
+                      scenario, count, r['wall_seconds'], r['peak_rss_mb'],
+                      r['requests'].get('listing', 0), r['requests'].get('es', 0),
+                      r['requests'].get('download', 0), r['jobs_submitted']))
+        finally: standin.shutdown()
+
+    # async and batch variants must produce exactly what the plain scenarios do
+    digests = dict([((r['scenario'], r['count']), r['output_digest']) for r in results])
+    mismatches = ["%s at %d files" % (s, c) for (s, c), d in sorted(digests.items())
+                  for suffix in VARIANT_SUFFIXES
+                  if s.endswith(suffix) and (s[:-len(suffix)], c) in digests
+                  and digests[(s[:-len(suffix)], c)] != d]
+    for m in mismatches: print("MISMATCH: %s differs from the plain scenario" % m)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if len(mismatches) > 0: sys.exit(1)
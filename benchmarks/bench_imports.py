@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Benchmark start-up import time of the job entry points with -X importtime
+and check that none of them imports dependencies left to the code paths
+that use them.
+"""
+
+import os, sys, json, time, argparse, subprocess
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that must not be imported by the entry points at start-up: the
+# HySDS client (loads Celery config), osaka and the process pool are only
+# needed to submit jobs, purge datasets and create datasets in parallel
+DEFERRED = ['hysds', 'hysds_commons', 'osaka', 'future', 'multiprocessing']
+
+ENTRY_POINTS = {
+    'create_orbit_ds': DEFERRED + ['crawl_orbits', 'download', 'listing', 'sqlite3'],
+    'create_cal_ds': DEFERRED + ['crawl_cals', 'download', 'listing', 'sqlite3'],
+    'crawl_orbits': DEFERRED,
+    'crawl_cals': DEFERRED,
+    'crawl_all': DEFERRED,
+}
+
+
+def parse_importtime(stderr):
+    """Return dict of module name to (self, cumulative) microseconds from
+    -X importtime output."""
+
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line: continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def bench(entry_point, repeat=5):
+    """Import entry_point in fresh interpreters. Return result dict with the
+    best of repeat runs."""
+
+    best = None
+    for i in range(repeat):
+        t0 = time.time()
+        p = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % entry_point],
+                           cwd=ROOT_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           universal_newlines=True)
+        wall = time.time() - t0
+        if p.returncode != 0:
+            raise RuntimeError("Failed to import %s:\n%s" % (entry_point, p.stderr))
+        modules = parse_importtime(p.stderr)
+        if best is None or wall < best['wall_seconds']:
+            best = {'wall_seconds': wall,
+                    'import_seconds': modules[entry_point][1] / 1e6,
+                    'modules': modules}
+    deferred = ENTRY_POINTS[entry_point]
+    best['deferred_imported'] = sorted([m for m in best['modules']
+                                        if m.split('.')[0] in deferred])
+    best['entry_point'] = entry_point
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entry_points", help="comma-separated entry point modules",
+                        default=",".join(sorted(ENTRY_POINTS)))
+    parser.add_argument("--repeat", help="number of runs per entry point, keeping the fastest",
+                        type=int, default=5)
+    parser.add_argument("--max_import_ms", help="fail if an entry point takes longer to import",
+                        type=float, required=False)
+    parser.add_argument("--top", help="number of slowest modules to list per entry point",
+                        type=int, default=5)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    results = []
+    failures = []
+    print("%-16s %10s %10s %8s  %s" % ("entry point", "wall (ms)", "import (ms)", "modules",
+                                       "slowest (cumulative ms)"))
+    for entry_point in args.entry_points.split(','):
+        if entry_point not in ENTRY_POINTS: parser.error("unknown entry point %s" % entry_point)
+        r = bench(entry_point, args.repeat)
+        modules = r.pop('modules')
+        r['module_count'] = len(modules)
+        slowest = sorted([(c, m) for m, (s, c) in modules.items() if m != entry_point],
+                         reverse=True)[:args.top]
+        r['slowest'] = [[m, c / 1e3] for c, m in slowest]
+        results.append(r)
+        print("%-16s %10.1f %10.1f %8d  %s" % (
+              entry_point, r['wall_seconds'] * 1e3, r['import_seconds'] * 1e3, len(modules),
+              ", ".join(["%s (%.1f)" % (m, c / 1e3) for c, m in slowest])))
+        if len(r['deferred_imported']) > 0:
+            failures.append("%s imports %s at start-up" % (entry_point,
+                                                          ", ".join(r['deferred_imported'])))
+        if args.max_import_ms is not None and r['import_seconds'] * 1e3 > args.max_import_ms:
+            failures.append("%s takes %.1f ms to import" % (entry_point,
+                                                           r['import_seconds'] * 1e3))
+    for f in failures: print("FAILED: %s" % f)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if len(failures) > 0: sys.exit(1)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Benchmark the streaming listing parser against the BeautifulSoup parser
+previously used by crawl_orbits on a recorded or synthetic listing.
+"""
+
+import os, sys, re, time, argparse, tracemalloc, requests
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from listing import iter_listing_links
+
+
+# same filter as crawl_orbits.ORBIT_HREF_RE
+ORBIT_HREF_RE = re.compile(r'^S1.*EOF$')
+
+
+class FixtureResponse(object):
+    """Minimal stand-in for a streamed requests response over a fixture."""
+
+    def __init__(self, content):
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i+chunk_size]
+
+
+def synthetic_listing(count, orbit_type="POEORB"):
+    """Return bytes of an Apache-style aux_poeorb/aux_resorb listing with count orbits."""
+
+    lines = ['<html><head><title>Index of /aux_%s</title></head><body>' % orbit_type.lower(),
+             '<h1>Index of /aux_%s</h1><pre>' % orbit_type.lower(),
+             '<a href="?C=N;O=D">Name</a> <a href="?C=M;O=A">Last modified</a>',
+             '<a href="/">Parent Directory</a>']
+    start = datetime(2014, 8, 1)
+    fmt = "%Y%m%dT%H%M%S"
+    for i in range(count):
+        vs = start + timedelta(days=i // 2)
+        ve = vs + timedelta(days=1, hours=2)
+        cr = ve + timedelta(days=19)
+        name = "S1%s_OPER_AUX_%s_OPOD_%s_V%s_%s.EOF" % ("AB"[i % 2], orbit_type, cr.strftime(fmt),
+                                                      vs.strftime(fmt), ve.strftime(fmt))
+        lines.append('<a href="%s">%s</a> %s 4.2M' % (name, name, cr.strftime("%d-%b-%Y %H:%M")))
+    lines.append('</pre></body></html>')
+    return "\n".join(lines).encode('utf-8')
+
+
+def parse_bs4(r):
+    """Previous crawl_orbits parser."""
+
+    from bs4 import BeautifulSoup
+    def is_orbit(href):
+        return href and re.compile(r'^S1.*EOF$').search(href)
+    parser = BeautifulSoup(r.text, 'html.parser')
+    parser.find_all(href=is_orbit)
+    parser.find_all(href=is_orbit)
+    return [a['href'] for a in parser.find_all(href=is_orbit)]
+
+
+def parse_streaming(r):
+    """Current crawl_orbits parser."""
+
+    return [href for orbit, href in iter_listing_links(r, ORBIT_HREF_RE)]
+
+
+def bench(name, parse, content, repeat):
+    """Return tuple of (best wall time, peak traced memory, result)."""
+
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        result = parse(FixtureResponse(content))
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    parse(FixtureResponse(content))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("%-10s %8d links %10.4f s %10.1f MiB peak" % (name, len(result), best, peak / 2.**20))
+    return best, peak, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--fixture", help="recorded listing file to parse")
+    parser.add_argument("--record", help="URL of listing to record into --fixture first")
+    parser.add_argument("--count", help="number of orbits in synthetic listing",
+                        type=int, default=20000)
+    parser.add_argument("--repeat", help="number of timed runs per parser",
+                        type=int, default=3)
+    args = parser.parse_args()
+
+    if args.record:
+        if not args.fixture: parser.error("--record requires --fixture")
+        r = requests.get(args.record, verify=False)
+        r.raise_for_status()
+        with open(args.fixture, 'wb') as f:
+            f.write(r.content)
+    if args.fixture:
+        with open(args.fixture, 'rb') as f:
+            content = f.read()
+    else: content = synthetic_listing(args.count)
+
+    print("listing size: %.1f MiB" % (len(content) / 2.**20))
+    bs4_res = bench("bs4", parse_bs4, content, args.repeat)
+    stream_res = bench("streaming", parse_streaming, content, args.repeat)
+    if bs4_res[2] != stream_res[2]:
+        raise RuntimeError("Parsers disagree on listing contents.")
+    print("speedup: %.1fx, memory: %.1fx" % (bs4_res[0] / stream_res[0],
+                                              bs4_res[1] / float(stream_res[1])))
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+"""
+Crawl orbits and calibration files in a single pass and ingest those not
+ingested into dataset ES.
+"""
+
+from builtins import str
+import os, json, logging, traceback, argparse
+
+import es_client
+import crawl_orbits, crawl_cals
+from crawl_state import STATE_DIR, CrawlState
+from id_catalog import CATALOG_FILE, CATALOG_TTL, IdCatalog
+from listing import LISTING_CACHE_DIR, ListingCache, map_ordered
+from listing_snapshot import SNAPSHOT_DIR, ListingSnapshots
+from metrics import metrics
+from mirrors import MIRRORS_FILE
+from qc_filenames import parse_query_time
+
+
+# set logger
+log_format = "[%(asctime)s: %(levelname)s/%(funcName)s] %(message)s"
+logging.basicConfig(format=log_format, level=logging.INFO)
+
+class LogFilter(logging.Filter):
+    def filter(self, record):
+        if not hasattr(record, 'id'): record.id = '--'
+        return True
+
+logger = logging.getLogger('crawl_all')
+logger.setLevel(logging.INFO)
+logger.addFilter(LogFilter())
+
+
+RESULTS_FILE = "_crawl_results.json"
+
+
+def get_snapshots(inps):
+    """Return ListingSnapshots to diff listings against, or None."""
+
+    if inps.no_snapshots or inps.start is not None: return None
+    return ListingSnapshots(inps.snapshot_dir)
+
+
+class OrbitCrawler(object):
+    """Precise and restituted orbits, ingested by submitted jobs."""
+
+    def __init__(self, inps, cache):
+        self.inps = inps
+        self.cache = cache
+        # backfills filter on the date range instead of watermarks
+        self.state = CrawlState(inps.state_file) \
+                     if inps.state_file and inps.start is None else None
+        self.snapshots = get_snapshots(inps)
+
+    def list(self):
+        """Return list of (id, url) tuples of orbits to check."""
+
+        inps = self.inps
+        return list(crawl_orbits.crawl_orbits(inps.dataset_version, inps.days_back, self.state,
+                                              inps.full_resync, self.cache, inps.workers,
+                                              inps.max_per_host, inps.quiet,
+                                              *crawl_orbits.get_orbit_mirrors(inps.mirrors_file),
+                                              start=inps.start, end=inps.end,
+                                              snapshots=self.snapshots))
+
+    def to_check(self, orbits):
+        """Return list of (id, url) tuples of orbits to check against ES."""
+
+        return orbits
+
+    def ingest(self, orbits, missing):
+        """Submit jobs for missing orbits. Return dict of results."""
+
+        inps = self.inps
+        return crawl_orbits.process_orbits(orbits, missing, inps.ds_es_url, inps.tag,
+                                           inps.dataset_version, inps.batch_size,
+                                           inps.prune_superseded, self.state, self.snapshots)
+
+
+class CalCrawler(object):
+    """Active calibration files, ingested in this process."""
+
+    def __init__(self, inps, cache):
+        self.inps = inps
+        self.cache = cache
+        self.data_mirrors = None
+        self.snapshots = get_snapshots(inps)
+        self.previous = None
+
+    def list(self):
+        """Return list of (id, url) tuples of active calibration files, or
+        of those listed in the backfill date range."""
+
+        inps = self.inps
+        listing_mirrors, self.data_mirrors = crawl_cals.get_cal_mirrors(inps.mirrors_file)
+        cals = list(crawl_cals.list_cals(inps.dataset_version, self.cache, inps.workers,
+                                         inps.max_per_host, listing_mirrors,
+                                         self.data_mirrors, inps.start, inps.end))
+        if self.snapshots is not None:
+            self.previous = self.snapshots.known(
+                crawl_cals.get_cal_snapshot_key(inps.dataset_version))
+            crawl_cals.stage_cal_snapshot(self.snapshots, inps.dataset_version,
+                                          [id for id, url in cals])
+        return cals
+
+    def to_check(self, cals):
+        """Return list of (id, url) tuples of calibration files added since
+        the last snapshot."""
+
+        if self.previous is None: return cals
+        return [(id, url) for id, url in cals if id not in self.previous]
+
+    def ingest(self, cals, missing):
+        """Create datasets for missing calibration files and refresh the
+        active calibration files dataset if it changed. Return dict of
+        results."""
+
+        inps = self.inps
+        active_ids = [id for id, url in cals] if inps.start is None else None
+        return crawl_cals.process_cals(crawl_cals.get_missing_cals(cals, missing),
+                                       inps.ds_es_url, inps.dataset_version, self.data_mirrors,
+                                       inps.download_workers, inps.download_parts, active_ids,
+                                       self.snapshots)
+
+
+# crawlers per product type in crawl order; new product types are added here
+CRAWLERS = [
+    ('orbit', OrbitCrawler),
+    ('calibration', CalCrawler),
+]
+
+
+def crawl(inps):
+    """Crawl product types in inps.types, sharing the listing cache, ID
+    catalog and batched ES checks. Return dict of results per type.
+
+    A product type whose listing or ingest fails is reported as failed
+    without stopping the others.
+    """
+
+    cache = None if inps.no_listing_cache else ListingCache(inps.listing_cache_dir)
+    crawlers = [(name, cls(inps, cache)) for name, cls in CRAWLERS if name in inps.types]
+
+    # list all product types concurrently
+    def list_items(crawler):
+        try: return crawler.list(), None
+        except Exception as e:
+            logger.error("Failed to list: %s\n%s" % (str(e), traceback.format_exc()))
+            return None, e
+    listed = map_ordered(list_items, [c for name, c in crawlers], len(crawlers))
+
+    # check IDs of all product types with the same batched queries
+    ids = [id for (name, crawler), (items, error) in zip(crawlers, listed)
+           if items is not None for id, url in crawler.to_check(items)]
+    check = lambda ids: es_client.find_ids(inps.ds_es_url, "grq", ids, inps.chunk_size)
+    if inps.no_id_catalog: missing = check(ids)
+    else:
+        catalog = IdCatalog(inps.id_catalog, inps.catalog_ttl)
+        missing = catalog.find_missing(inps.dataset_version, ids, check)
+        catalog.close()
+    metrics.incr('found', len(ids) - len(missing))
+    metrics.incr('missing', len(missing))
+
+    results = {}
+    for (name, crawler), (items, error) in zip(crawlers, listed):
+        result = {}
+        if error is None:
+            result['listed'] = len(items)
+            result['missing'] = len([id for id, url in items if id in missing])
+            try: result.update(crawler.ingest(items, missing))
+            except Exception as e:
+                logger.error("Failed to ingest %s: %s\n%s" % (name, str(e),
+                                                              traceback.format_exc()))
+                error = e
+        result['status'] = 'ok' if error is None else 'failed'
+        if error is not None: result['error'] = str(error)
+        logger.info("%s: %s" % (name, json.dumps(result, sort_keys=True)))
+        results[name] = result
+    return results
+
+
+def cmdLineParse():
+    """Command line parser."""
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("ds_es_url", help="ElasticSearch URL for datasets, e.g. " +
+                        "http://aria-products.jpl.nasa.gov:9200")
+    parser.add_argument("--dataset_version", help="dataset version",
+                        default="v1.1", required=False)
+    parser.add_argument("--tag", help="PGE docker image tag (release, version, " +
+                                      "or branch) to propagate",
+                        default="master", required=False)
+    parser.add_argument("--types", help="comma-separated product types to crawl",
+                        default=",".join([name for name, cls in CRAWLERS]), required=False)
+    parser.add_argument("--days_back", help="How far back to query for orbits relative to " +
+                                            "today; only applies without crawl state " +
+                                            "(--state_file '')",
+                        default="1", required=False)
+    parser.add_argument("--state_file", help="crawl state file recording the newest " +
+                                             "orbit production time seen per listing",
+                        default=os.path.join(STATE_DIR, "crawl_orbits_state.json"),
+                        required=False)
+    parser.add_argument("--full_resync", help="ignore crawl state and process full listings",
+                        action="store_true", default=False)
+    parser.add_argument("--listing_cache_dir", help="directory caching listings for " +
+                                                  "conditional requests",
+                        default=LISTING_CACHE_DIR, required=False)
+    parser.add_argument("--no_listing_cache", help="always fetch and parse full listings",
+                        action="store_true", default=False)
+    parser.add_argument("--id_catalog", help="local catalog of dataset IDs confirmed " +
+                                             "ingested, checked before ES",
+                        default=CATALOG_FILE, required=False)
+    parser.add_argument("--no_id_catalog", help="check all IDs against ES",
+                        action="store_true", default=False)
+    parser.add_argument("--snapshot_dir", help="directory of listing snapshots; only " +
+                                               "products added since the last snapshot " +
+                                               "are processed and removals are reported",
+                        default=SNAPSHOT_DIR, required=False)
+    parser.add_argument("--no_snapshots", help="process listings without diffing them " +
+                                               "against snapshots",
+                        action="store_true", default=False)
+    parser.add_argument("--catalog_ttl", help="days before a cataloged ID is checked " +
+                                              "against ES again",
+                        type=float, default=CATALOG_TTL, required=False)
+    parser.add_argument("--mirrors_file", help="JSON file of listing and data server " +
+                                               "mirrors per product type",
+                        default=MIRRORS_FILE, required=False)
+    parser.add_argument("--workers", help="number of listings to fetch concurrently " +
+                                          "per product type",
+                        type=int, default=4, required=False)
+    parser.add_argument("--max_per_host", help="maximum concurrent requests per server",
+                        type=int, default=4, required=False)
+    parser.add_argument("--batch_size", help="number of missing orbits to ingest per job",
+                        type=int, default=1, required=False)
+    parser.add_argument("--prune_superseded", help="skip RESORBs covered by a POEORB or " +
+                                                 "a newer RESORB",
+                        action="store_true", default=False)
+    parser.add_argument("--download_workers", help="number of calibration files to " +
+                                                  "download concurrently",
+                        type=int, default=2, required=False)
+    parser.add_argument("--download_parts", help="number of concurrent ranges to fetch " +
+                                                "each large calibration file in",
+                        type=int, default=1, required=False)
+    parser.add_argument("--chunk_size", help="number of IDs to check per ES query",
+                        type=int, default=500, required=False)
+    parser.add_argument("--quiet", help="do not print every listed orbit",
+                        action="store_true", default=False)
+    parser.add_argument("--start", help="backfill products from this date, e.g. " +
+                                        "2017-01-01, ignoring crawl state",
+                        required=False)
+    parser.add_argument("--end", help="end (exclusive) of the backfill date range",
+                        required=False)
+    inps = parser.parse_args()
+    if (inps.start is None) != (inps.end is None):
+        parser.error("specify both or neither of --start and --end")
+    if inps.start is not None:
+        inps.start, inps.end = parse_query_time(inps.start), parse_query_time(inps.end)
+    inps.types = inps.types.split(',')
+    unknown = [t for t in inps.types if t not in dict(CRAWLERS)]
+    if len(unknown) > 0: parser.error("unknown product types: %s" % ", ".join(unknown))
+    return inps
+
+
+if __name__ == '__main__':
+    inps = cmdLineParse()
+    try:
+        results = crawl(inps)
+        with open(RESULTS_FILE, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        failed = [name for name, result in results.items() if result['status'] != 'ok']
+        if len(failed) > 0:
+            raise RuntimeError("Failed to crawl %s: %s" % (", ".join(failed), "; ".join(
+                               [results[name]['error'] for name in failed])))
+    except Exception as e:
+        with open('_alt_error.txt', 'w') as f:
+            f.write("%s\n" % str(e))
+        with open('_alt_traceback.txt', 'w') as f:
+            f.write("%s\n" % traceback.format_exc())
+        raise
+    finally: metrics.write()
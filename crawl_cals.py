@@ -3,19 +3,28 @@
 Crawl calibration files, create and ingest calibration datasets.
 """
 
-from future import standard_library
-standard_library.install_aliases()
 from builtins import str
-import os, sys, re, json, logging, traceback, requests, argparse, backoff, shutil
+import os, sys, json, hashlib, logging, traceback, requests, argparse
+import threading
+import asyncio
+from queue import Queue, Empty
 from datetime import datetime, timedelta
 from requests.packages.urllib3.exceptions import (InsecureRequestWarning,
                                                   InsecurePlatformWarning)
 try: from html.parser import HTMLParser
 except: from html.parser import HTMLParser
 
-from osaka.main import get, rmall
-
-from create_cal_ds import check_cal, create_cal_ds
+import es_client
+from async_utils import EndpointLimiter, chunks
+from create_cal_ds import check_cals, create_cal_ds
+from id_catalog import CATALOG_FILE, CATALOG_TTL, IdCatalog
+from listing_snapshot import SNAPSHOT_DIR, ListingSnapshots, diff_sorted
+from download import download
+from metrics import metrics
+from mirrors import MIRRORS_FILE, MirrorSet, get_mirrors, load_mirrors
+from qc_filenames import format_time, parse_cal_name, parse_query_time, to_datetime
+from listing import (LISTING_CACHE_DIR, ListingCache, HostLimiter, fetch_listing,
+                     get_session, map_ordered)
 
 
 # disable warnings for SSL verification
@@ -43,8 +52,6 @@ DATA_SERVER = 'http://aux.sentinel1.eo.esa.int/'
 # QC_SERVER = 'http://aux.sentinel1.eo.esa.int/'
 QC_SERVER = 'https://qc.sentinel1.groupcls.com/'
 
-CAL_RE = re.compile(r'(?P<sat>S1\w)_(?P<type>AUX_CAL)_V(?P<dt>\d{8}T\d{6})')
-
 
 def cmdLineParse():
     """Command line parser."""
@@ -57,7 +64,54 @@ def cmdLineParse():
     parser.add_argument("--tag", help="PGE docker image tag (release, version, " +
                                       "or branch) to propagate",
                         default="master", required=False)
-    return parser.parse_args()
+    parser.add_argument("--listing_cache_dir", help="directory caching listings for " +
+                                                  "conditional requests",
+                        default=LISTING_CACHE_DIR, required=False)
+    parser.add_argument("--no_listing_cache", help="always fetch and parse full listings",
+                        action="store_true", default=False)
+    parser.add_argument("--id_catalog", help="local catalog of dataset IDs confirmed " +
+                                             "ingested, checked before ES",
+                        default=CATALOG_FILE, required=False)
+    parser.add_argument("--no_id_catalog", help="check all IDs against ES",
+                        action="store_true", default=False)
+    parser.add_argument("--catalog_ttl", help="days before a cataloged ID is checked " +
+                                              "against ES again",
+                        type=float, default=CATALOG_TTL, required=False)
+    parser.add_argument("--mirrors_file", help="JSON file of listing and data server " +
+                                               "mirrors per product type",
+                        default=MIRRORS_FILE, required=False)
+    parser.add_argument("--snapshot_dir", help="directory of listing snapshots; only " +
+                                               "calibration files added since the last " +
+                                               "snapshot are checked and removals are reported",
+                        default=SNAPSHOT_DIR, required=False)
+    parser.add_argument("--no_snapshots", help="check every listed calibration file",
+                        action="store_true", default=False)
+    parser.add_argument("--workers", help="number of listing pages to fetch concurrently",
+                        type=int, default=4, required=False)
+    parser.add_argument("--max_per_host", help="maximum concurrent requests per server",
+                        type=int, default=4, required=False)
+    parser.add_argument("--download_workers", help="number of calibration files to " +
+                                                  "download concurrently",
+                        type=int, default=2, required=False)
+    parser.add_argument("--download_parts", help="number of concurrent ranges to fetch " +
+                                                "each large calibration file in",
+                        type=int, default=1, required=False)
+    parser.add_argument("--chunk_size", help="maximum number of calibration IDs to " +
+                                             "check per ES query",
+                        type=int, default=500, required=False)
+    parser.add_argument("--async", help="run checks, downloads and dataset creation as " +
+                                        "tasks on an event loop",
+                        dest="use_async", action="store_true", default=False)
+    parser.add_argument("--start", help="backfill calibration files from the daily " +
+                                        "listings starting at this date, e.g. 2017-01-01; " +
+                                        "the active calibration dataset is left as is",
+                        required=False)
+    parser.add_argument("--end", help="end (exclusive) of the backfill date range",
+                        required=False)
+    inps = parser.parse_args()
+    if (inps.start is None) != (inps.end is None):
+        parser.error("specify both or neither of --start and --end")
+    return inps
 
 
 class MyHTMLParser(HTMLParser):
@@ -84,7 +138,7 @@ class MyHTMLParser(HTMLParser):
 
     def handle_data(self,data):
         if self.in_a:
-            if CAL_RE.search(data):
+            if parse_cal_name(data.strip()) is not None:
                 self.fileList.append(data.strip())
 
     def handle_endtag(self, tag):
@@ -103,69 +157,120 @@ class MyHTMLParser(HTMLParser):
                 self.pages -= 2
 
 
-@backoff.on_exception(backoff.expo, requests.exceptions.RequestException,
-                      max_tries=8, max_value=32)
-def session_get(session, url):
-    return session.get(url, verify=False)
+def parse_cal_listing(r):
+    """Return dict of calibration files and page count in listing response."""
+
+    parser = MyHTMLParser()
+    parser.feed(r.text)
+    return {"files": parser.fileList, "pages": parser.pages}
+
+
+def get_cal_url(res, data_server=None):
+    """Return download URL of calibration file on data_server (DATA_SERVER
+    by default)."""
+
+    info = parse_cal_name(res)
+    if info is None:
+        raise RuntimeError("Failed to parse cal: {}".format(res))
+    if data_server is None: data_server = DATA_SERVER
+    return os.path.join(data_server, "product", info.sat, "AUX_%s" % info.type,
+                        format_time(info.start), "{}.SAFE.TGZ".format(res))
+
+
+def get_cal_snapshot_key(dataset_version):
+    """Return key of the active calibration files listing snapshot."""
+
+    return "%s/AUX_CAL" % dataset_version
 
 
-def crawl_cals(dataset_version):
-    """Crawl for calibration urls."""
-    date_today = datetime.now()
+def stage_cal_snapshot(snapshots, dataset_version, ids):
+    """Stage listed calibration file ids as the new snapshot, unless the
+    listing came back empty, which is taken as unavailable rather than as
+    every calibration file being deactivated."""
+
+    if len(ids) > 0: snapshots.diff(get_cal_snapshot_key(dataset_version), ids)
+
+
+def get_cal_mirrors(mirrors_file=None):
+    """Return tuple of (listing, data) MirrorSets of calibration files,
+    ranked by probing when there is a choice."""
+
+    config = load_mirrors(mirrors_file)
+    session = get_session(1)
+    mirrors = (get_mirrors(config, 'cal', 'listing', QC_SERVER, session),
+               get_mirrors(config, 'cal', 'data', DATA_SERVER, session))
+    session.close()
+    return mirrors
+
+
+def crawl_cals(dataset_version, cache=None, workers=1, max_per_host=4, listing_mirrors=None,
+               data_mirrors=None, day=None):
+    """Crawl for calibration urls in the listing of day (today by default).
+
+    Pages known from the pagination of the first page are fetched with up
+    to workers threads and processed in page order. Pages fail over between
+    listing_mirrors and URLs point at the best of data_mirrors (QC_SERVER
+    and DATA_SERVER by default).
+    """
+    date_today = datetime.now() if day is None else day
     yyyy = date_today.strftime("%Y")
     mm = date_today.strftime("%m")
     dd = date_today.strftime("%d")
     date = yyyy + '/' + mm + '/' + dd + '/'
 
     results = {}
-    session = requests.Session()
+    session = get_session(workers)
+    limiter = HostLimiter(max_per_host)
+    if listing_mirrors is None: listing_mirrors = MirrorSet([QC_SERVER])
+    if data_mirrors is None: data_mirrors = MirrorSet([DATA_SERVER])
     oType = 'calibration'
-    url = QC_SERVER + 'AUX_CAL'
+    path = 'AUX_CAL'
     page_limit = 100
     #query = url + '/?adf__active=True'
-    query = url + '/' + date
+    query = path + '/' + date
 
-    logger.info(query)
+    def fetch_from(server, query):
+        logger.info(server + query)
+        r, listing = fetch_listing(session, server + query, parse_cal_listing, cache, limiter)
+        if r.status_code >= 500: r.raise_for_status()
+        return r, listing
 
     logger.info('Querying for {0} calibration files'.format(oType))
-    r = session_get(session, query)
-    if r.status_code != 200:
-        logger.info("No calibrations found at this url: {}".format(query))
+    r, listing = listing_mirrors.call(lambda server: fetch_from(server, query))
+    if listing is None:
+        logger.info("No calibrations found at this url: {}".format(listing_mirrors.current + query))
         return
     #r.raise_for_status()
-    parser = MyHTMLParser()
-    parser.feed(r.text)
-    logger.info("Found {} pages".format(parser.pages))
+    logger.info("Found {} pages".format(listing['pages']))
 
-    for res in parser.fileList:
+    for res in listing['files']:
         id = "%s-%s" % (os.path.splitext(res)[0], dataset_version)
-        results[id] = os.path.join(url, res)
-        match = CAL_RE.search(res)
-        if not match:
-            raise RuntimeError("Failed to parse cal: {}".format(res))
-        results[id] = os.path.join(DATA_SERVER, "product", "/".join(match.groups()), "{}.SAFE.TGZ".format(res))
+        results[id] = get_cal_url(res, data_mirrors.current)
         yield id, results[id]
 
+    def fetch_page(page):
+        page_query = "{}?page={}".format(query, page)
+        r, page_listing = listing_mirrors.call(lambda server: fetch_from(server, page_query))
+        r.raise_for_status()
+        return page_listing
+
+    # fetch known pages concurrently
+    known_pages = list(range(2, min(listing['pages'], page_limit) + 1))
+    prefetched = dict(zip(known_pages, map_ordered(fetch_page, known_pages, workers)))
+
     # page through and get more results
     page = 2
     reached_end = False
     while True:
-        page_query = "{}?page={}".format(query, page)
-        logger.info(page_query)
-        r = session_get(session, page_query)
-        r.raise_for_status()
-        page_parser = MyHTMLParser()
-        page_parser.feed(r.text)
-        for res in page_parser.fileList:
+        if page in prefetched: page_listing = prefetched.pop(page)
+        else: page_listing = fetch_page(page)
+        for res in page_listing['files']:
             id = "%s-%s" % (os.path.splitext(res)[0], dataset_version)
             if id in results or page >= page_limit:
                 reached_end = True
                 break
             else:
-                match = CAL_RE.search(res)
-                if not match:
-                    raise RuntimeError("Failed to parse cal: {}".format(res))
-                results[id] = os.path.join(DATA_SERVER, "product", "/".join(match.groups()), "{}.SAFE.TGZ".format(res))
+                results[id] = get_cal_url(res, data_mirrors.current)
                 yield id, results[id]
         if reached_end: break
         else: page += 1
@@ -177,8 +282,44 @@ def crawl_cals(dataset_version):
     logger.info(len(results))
 
 
-def create_active_cal_ds(active_ids, dataset_version, root_ds_dir="."):
-    """Create active calibration files dataset."""
+def crawl_cal_days(dataset_version, start, end, cache=None, workers=1, max_per_host=4,
+                   listing_mirrors=None, data_mirrors=None):
+    """Crawl for calibration urls in the listings of the days in [start,
+    end) (epoch seconds), yielding each calibration file once."""
+
+    seen = set()
+    day = to_datetime(start - start % 86400)
+    while day < to_datetime(end):
+        for id, url in crawl_cals(dataset_version, cache, workers, max_per_host,
+                                  listing_mirrors, data_mirrors, day):
+            if id in seen: continue
+            seen.add(id)
+            yield id, url
+        day += timedelta(days=1)
+
+
+def list_cals(dataset_version, cache=None, workers=1, max_per_host=4, listing_mirrors=None,
+              data_mirrors=None, start=None, end=None):
+    """Return iterator of (id, url) of today's calibration files, or of
+    those in the daily listings of [start, end) if given."""
+
+    if start is None:
+        return crawl_cals(dataset_version, cache, workers, max_per_host, listing_mirrors,
+                          data_mirrors)
+    return crawl_cal_days(dataset_version, start, end, cache, workers, max_per_host,
+                          listing_mirrors, data_mirrors)
+
+
+def get_active_ids_hash(active_ids):
+    """Return sha256 hex digest of sorted unique active_ids."""
+
+    return hashlib.sha256('\n'.join(sorted(set(active_ids))).encode('utf-8')).hexdigest()
+
+
+def create_active_cal_ds(active_ids, dataset_version, root_ds_dir=".", added=None,
+                         removed=None):
+    """Create active calibration files dataset, recording the hash of
+    active_ids and, if given, the IDs added and removed since the last one."""
 
     # set id
     id = "S1_AUX_CAL_ACTIVE"
@@ -191,7 +332,10 @@ def create_active_cal_ds(active_ids, dataset_version, root_ds_dir="."):
         "sensor": "SAR-C Sentinel1",
         "dataset": "S1-AUX_CAL_ACTIVE",
         "active_ids": active_ids,
+        "active_ids_hash": get_active_ids_hash(active_ids),
     }
+    if added is not None: met['active_ids_added'] = added
+    if removed is not None: met['active_ids_removed'] = removed
     logger.info("met: %s" % json.dumps(met, indent=2, sort_keys=True))
 
     # get dataset json
@@ -222,10 +366,9 @@ def create_active_cal_ds(active_ids, dataset_version, root_ds_dir="."):
     return id, ds_dir
 
 
-@backoff.on_exception(backoff.expo, requests.exceptions.RequestException,
-                      max_tries=8, max_value=32)
-def purge_active_cal_ds(es_url, dataset_version):
-    """Purge active cal dataset."""
+def get_active_cal_ds(es_url, dataset_version):
+    """Return fields (urls, metadata.active_ids and metadata.active_ids_hash)
+    of the ingested active cal dataset, or None if there is none."""
 
     id = "S1_AUX_CAL_ACTIVE"
     query = {
@@ -236,59 +379,303 @@ def purge_active_cal_ds(es_url, dataset_version):
                 ]
             }
         },
-        "fields": [ "urls" ],
+        "fields": [ "urls", "metadata.active_ids", "metadata.active_ids_hash" ],
     }
     es_index = "grq_%s_s1-aux_cal_active" % dataset_version
-    if es_url.endswith('/'):
-        search_url = '%s%s/_search' % (es_url, es_index)
-    else:
-        search_url = '%s/%s/_search' % (es_url, es_index)
-    #logger.info("search_url: %s" % search_url)
-    r = requests.post(search_url, data=json.dumps(query))
+    r = es_client.search(es_url, es_index, query)
     if r.status_code == 200:
         result = r.json()
         #logger.info(pformat(result))
         total = result['hits']['total']
-        if total > 0:
-            hit = result['hits']['hits'][0]['fields']
-            for url in hit['urls']:
-                if not (url.startswith('http') or url.startswith('ftp')):
-                    rmall(url)
+        if total > 0: return result['hits']['hits'][0].get('fields', {})
     else:
-        logger.error("Failed to query %s:\n%s" % (es_url, r.text))
-        logger.error("query: %s" % json.dumps(query, indent=2))
-        logger.error("returned: %s" % r.text)
+        es_client.log_failure(es_url, query, r)
         if r.status_code != 404: r.raise_for_status()
+    return None
+
+
+def purge_active_cal_ds(es_url, dataset_version, hit=None):
+    """Purge active cal dataset, using its fields in hit if already queried."""
+
+    from osaka.main import rmall
+
+    if hit is None: hit = get_active_cal_ds(es_url, dataset_version)
+    if hit is None: return
+    for url in hit.get('urls', []):
+        if not (url.startswith('http') or url.startswith('ftp')):
+            rmall(url)
+
+
+def update_active_cal_ds(es_url, dataset_version, active_ids, root_ds_dir="."):
+    """Purge and recreate active cal dataset unless active_ids is empty or
+    its hash matches that of the ingested one. Return True if it was
+    recreated."""
+
+    # as in stage_cal_snapshot, an empty listing is taken as unavailable
+    # (fetch_listing returns None on errors) rather than as every
+    # calibration file being deactivated
+    if len(active_ids) == 0:
+        logger.warning("No active calibration files listed. Skipping update.")
+        metrics.incr('active_cal_skipped')
+        return False
+
+    hit = get_active_cal_ds(es_url, dataset_version)
+    active_ids_hash = get_active_ids_hash(active_ids)
+    if hit is not None and hit.get('metadata.active_ids_hash', [None])[0] == active_ids_hash:
+        logger.info("Active calibration files unchanged (%s). Skipping update." %
+                    active_ids_hash)
+        metrics.incr('active_cal_unchanged')
+        return False
+
+    # datasets ingested before hashes were recorded still list their IDs
+    added = removed = None
+    if hit is not None and 'metadata.active_ids' in hit:
+        added, removed = diff_sorted(sorted(set(hit['metadata.active_ids'])),
+                                     sorted(set(active_ids)))
+        logger.info("Active calibration files changed: %d added, %d removed." %
+                    (len(added), len(removed)))
+    if hit is not None: purge_active_cal_ds(es_url, dataset_version, hit)
+    create_active_cal_ds(active_ids, dataset_version, root_ds_dir, added, removed)
+    return True
+
+
+def download_cal(url, session=None, parts=1):
+    """Download calibration tar file, resuming an interrupted download.
+    Return tuple of (path of SAFE tar file, (size, sha256 hex digest))."""
+
+    safe_tar_file = os.path.basename(url).replace('.TGZ', '')
+    checksum = download(url, safe_tar_file, session, parts)
+    return safe_tar_file, checksum
+
+
+def ingest_cal(id, url, ds_es_url, dataset_version, data_mirrors=None, session=None,
+               download_parts=1, create_lock=None):
+    """Download calibration file id from url, failing over between
+    data_mirrors, and create its dataset, holding create_lock (if given)
+    while creating. Log and re-raise any error."""
+
+    if data_mirrors is None: data_mirrors = MirrorSet([DATA_SERVER])
+    if create_lock is None: create_lock = threading.Lock()
+    try:
+        safe_tar_file, checksum = data_mirrors.with_failover(
+            url, lambda url: download_cal(url, session, download_parts))
+        with create_lock:
+            create_cal_ds(safe_tar_file, ds_es_url, dataset_version, dedup=False,
+                          placement="move", checksum=checksum)
+    except Exception as e:
+        logger.error("Failed to ingest calibration file %s: %s" % (id, str(e)))
+        metrics.incr('ingest_failed')
+        raise
 
 
-def crawl(ds_es_url, dataset_version, tag):
-    """Crawl for calibration files and create datasets if they don't exist in ES."""
+def get_missing_cals(cals, missing):
+    """Log status of each calibration file of (id, url) tuples. Return list
+    of those whose IDs are in missing."""
 
-    active_ids = []
-    for id, url in crawl_cals(dataset_version):
-        #logger.info("%s: %s" % (id, url))
-        active_ids.append(id)
-        total, found_id = check_cal(ds_es_url, "grq", id)
-        if total > 0:
-            logger.info("Found %s." % id)
-        else:
+    to_ingest = []
+    for id, url in cals:
+        if id in missing:
             logger.info("Missing %s. Creating dataset." % id)
-            cal_tar_file = os.path.basename(url)
-            get(url, cal_tar_file)
-            safe_tar_file = cal_tar_file.replace('.TGZ', '')
-            shutil.move(cal_tar_file, safe_tar_file)
-            create_cal_ds(safe_tar_file, ds_es_url, dataset_version)
-    purge_active_cal_ds(ds_es_url, dataset_version)
-    create_active_cal_ds(active_ids, dataset_version)
-
+            to_ingest.append((id, url))
+        else: logger.info("Found %s." % id)
+    return to_ingest
+
+
+def process_cals(cals, ds_es_url, dataset_version, data_mirrors=None, download_workers=2,
+                 download_parts=1, active_ids=None, snapshots=None):
+    """Ingest missing calibration files of (id, url) tuples with up to
+    download_workers threads, creating one dataset at a time. cals may be
+    a generator, which is consumed as it yields. Once all were attempted,
+    raise the first error, or refresh the active calibration files dataset
+    from active_ids unless it is None and save the staged snapshots.
+    Return dict of results."""
+
+    cals = iter(cals)
+    download_workers = max(1, download_workers)
+    session = get_session(download_workers * max(1, download_parts))
+    next_lock = threading.Lock()
+    create_lock = threading.Lock()
+    created = []
+    errors = []
+
+    def ingest_stage(i):
+        while True:
+            try:
+                with next_lock: item = next(cals, None)
+            except Exception as e:
+                errors.append(e)
+                break
+            if item is None: break
+            id, url = item
+            try:
+                ingest_cal(id, url, ds_es_url, dataset_version, data_mirrors, session,
+                           download_parts, create_lock)
+                created.append(id)
+            except Exception as e: errors.append(e)
+
+    map_ordered(ingest_stage, range(download_workers), download_workers)
+    session.close()
+    if len(errors) > 0: raise errors[0]
+    result = {'datasets_created': len(created)}
+    if active_ids is not None:
+        result['active_updated'] = update_active_cal_ds(ds_es_url, dataset_version,
+                                                        active_ids)
+    if snapshots is not None:
+        result['removed'] = snapshots.removed
+        snapshots.save()
+    return result
+
+
+def crawl(ds_es_url, dataset_version, tag, listing_cache_dir=None, workers=1,
+          max_per_host=4, download_workers=2, chunk_size=500, download_parts=1,
+          catalog_file=None, catalog_ttl=CATALOG_TTL, mirrors_file=None, start=None,
+          end=None, snapshot_dir=None):
+    """Crawl for calibration files and create datasets if they don't exist in ES.
+
+    Listing and existence checks run as stages joined by queues, feeding
+    missing calibration files to process_cals() as they are found. With a
+    catalog_file, only calibration files not confirmed ingested within the
+    last catalog_ttl days are checked against ES. Mirrors are read from
+    mirrors_file. With start and end, the daily listings of [start, end)
+    are backfilled and the active calibration files dataset is left as is,
+    as backfills cover past listings. With a snapshot_dir, only active
+    calibration files added since the last snapshot are checked and
+    deactivated ones are reported.
+    """
+
+    cache = ListingCache(listing_cache_dir) if listing_cache_dir else None
+    listing_mirrors, data_mirrors = get_cal_mirrors(mirrors_file)
+    snapshots = ListingSnapshots(snapshot_dir) if snapshot_dir and start is None else None
+    active_ids = []
+    errors = []
+    check_q = Queue()
+    download_q = Queue()
+    catalog = IdCatalog(catalog_file, catalog_ttl) if catalog_file else None
+    check = lambda ids: check_cals(ds_es_url, "grq", ids, chunk_size)
+
+    def list_stage():
+        try:
+            previous = None
+            if snapshots is not None:
+                previous = snapshots.known(get_cal_snapshot_key(dataset_version))
+            for id, url in list_cals(dataset_version, cache, workers, max_per_host,
+                                     listing_mirrors, data_mirrors, start, end):
+                #logger.info("%s: %s" % (id, url))
+                active_ids.append(id)
+                if previous is None or id not in previous: check_q.put((id, url))
+            if snapshots is not None: stage_cal_snapshot(snapshots, dataset_version, active_ids)
+        except Exception as e:
+            logger.error("Failed to crawl calibration files: %s" % str(e))
+            errors.append(e)
+        finally:
+            check_q.put(None)
+
+    def check_stage():
+        try:
+            done = False
+            while not done:
+                # check whatever the listing has queued up in a single query
+                chunk = [check_q.get()]
+                while len(chunk) < chunk_size and chunk[-1] is not None:
+                    try: chunk.append(check_q.get_nowait())
+                    except Empty: break
+                if chunk[-1] is None:
+                    done = True
+                    chunk.pop()
+                if len(chunk) == 0: continue
+                ids = [id for id, url in chunk]
+                if catalog: missing = catalog.find_missing(dataset_version, ids, check)
+                else: missing = check(ids)
+                metrics.incr('found', len(chunk) - len(missing))
+                metrics.incr('missing', len(missing))
+                for item in get_missing_cals(chunk, missing): download_q.put(item)
+        except Exception as e:
+            logger.error("Failed to check calibration files: %s" % str(e))
+            errors.append(e)
+        finally:
+            download_q.put(None)
+
+    def missing_cals():
+        while True:
+            item = download_q.get()
+            if item is None: break
+            yield item
+        # keep a failed listing or check from refreshing the active dataset
+        if len(errors) > 0: raise errors[0]
+
+    threads = [threading.Thread(target=list_stage), threading.Thread(target=check_stage)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        process_cals(missing_cals(), ds_es_url, dataset_version, data_mirrors,
+                     download_workers, download_parts,
+                     active_ids if start is None else None, snapshots)
+    finally:
+        for t in threads: t.join()
+        if catalog: catalog.close()
+
+
+async def crawl_async(ds_es_url, dataset_version, tag, listing_cache_dir=None, workers=1,
+                      max_per_host=4, download_workers=2, chunk_size=500, download_parts=1,
+                      catalog_file=None, catalog_ttl=CATALOG_TTL, mirrors_file=None,
+                      start=None, end=None, snapshot_dir=None):
+    """Same as crawl(), but listing, ES checks and ingestion run one after
+    the other from an event loop, with ES chunks checked concurrently with
+    at most max_per_host queries in flight."""
+
+    cache = ListingCache(listing_cache_dir) if listing_cache_dir else None
+    limiter = EndpointLimiter({'qc': 1, 'es': max_per_host, 'data': 1})
+    try:
+        listing_mirrors, data_mirrors = await limiter.run('qc', get_cal_mirrors, mirrors_file)
+        cals = await limiter.run('qc', lambda: list(list_cals(dataset_version, cache,
+                                                              workers, max_per_host,
+                                                              listing_mirrors, data_mirrors,
+                                                              start, end)))
+        active_ids = [id for id, url in cals]
+        snapshots = ListingSnapshots(snapshot_dir) if snapshot_dir and start is None else None
+        previous = None
+        if snapshots is not None:
+            previous = snapshots.known(get_cal_snapshot_key(dataset_version))
+            stage_cal_snapshot(snapshots, dataset_version, active_ids)
+        ids = [id for id in active_ids if previous is None or id not in previous]
+        catalog = IdCatalog(catalog_file, catalog_ttl) if catalog_file else None
+        known = catalog.known(dataset_version, ids) if catalog else set()
+        unknown = [id for id in ids if id not in known]
+        missing = set().union(*(await limiter.map(
+            'es', lambda chunk: check_cals(ds_es_url, "grq", chunk, chunk_size),
+            chunks(unknown, chunk_size))))
+        if catalog:
+            catalog.add(dataset_version, [id for id in unknown if id not in missing])
+            catalog.close()
+        metrics.incr('found', len(ids) - len(missing))
+        metrics.incr('missing', len(missing))
+        await limiter.run('data', process_cals, get_missing_cals(cals, missing), ds_es_url,
+                          dataset_version, data_mirrors, download_workers, download_parts,
+                          active_ids if start is None else None, snapshots)
+    finally: limiter.shutdown()
 
 if __name__ == '__main__':
     inps = cmdLineParse()
-    try: status = crawl(inps.ds_es_url, inps.dataset_version, inps.tag)
+    kwargs = dict(ds_es_url=inps.ds_es_url, dataset_version=inps.dataset_version,
+                  tag=inps.tag,
+                  listing_cache_dir=None if inps.no_listing_cache else inps.listing_cache_dir,
+                  workers=inps.workers, max_per_host=inps.max_per_host,
+                  download_workers=inps.download_workers, chunk_size=inps.chunk_size,
+                  download_parts=inps.download_parts,
+                  catalog_file=None if inps.no_id_catalog else inps.id_catalog,
+                  catalog_ttl=inps.catalog_ttl, mirrors_file=inps.mirrors_file,
+                  start=None if inps.start is None else parse_query_time(inps.start),
+                  end=None if inps.end is None else parse_query_time(inps.end),
+                  snapshot_dir=None if inps.no_snapshots else inps.snapshot_dir)
+    try:
+        if inps.use_async: status = asyncio.run(crawl_async(**kwargs))
+        else: status = crawl(**kwargs)
     except Exception as e:
         with open('_alt_error.txt', 'w') as f:
             f.write("%s\n" % str(e))
         with open('_alt_traceback.txt', 'w') as f:
             f.write("%s\n" % traceback.format_exc())
         raise
+    finally: metrics.write()
     sys.exit(status)
@@ -3,20 +3,24 @@
 Crawl orbits and submit orbit dataset generation jobs.
 """
 
-from future import standard_library
-standard_library.install_aliases()
 from builtins import str
-import os, sys, re, json, logging, traceback, requests, argparse, backoff
+import os, sys, re, logging, traceback, requests, argparse, asyncio
 from datetime import datetime, timedelta
-from pprint import pformat
 from requests.packages.urllib3.exceptions import (InsecureRequestWarning,
                                                   InsecurePlatformWarning)
-try: from html.parser import HTMLParser
-except: from html.parser import HTMLParser
 
-from hysds_commons.job_utils import submit_mozart_job
-from hysds.celery import app
-from bs4 import BeautifulSoup
+from async_utils import EndpointLimiter, chunks
+from create_orbit_ds import check_orbits
+from crawl_state import STATE_DIR, CrawlState
+from id_catalog import CATALOG_FILE, CATALOG_TTL, IdCatalog
+from listing_snapshot import SNAPSHOT_DIR, ListingSnapshots
+from metrics import metrics
+from mirrors import MIRRORS_FILE, MirrorSet, get_mirrors, load_mirrors
+from orbit_index import get_ingested_orbits, prune_superseded
+from qc_common import ORBIT_SERVER, submit_mozart_job
+from qc_filenames import format_time, parse_orbit_name, parse_query_time
+from listing import (LISTING_CACHE_DIR, ListingCache, HostLimiter, fetch_listing,
+                     get_session, iter_listing_links, map_ordered)
 
 # disable warnings for SSL verification
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
@@ -41,13 +45,13 @@ logger.addFilter(LogFilter())
 #QC_SERVER = 'http://aux.sentinel1.eo.esa.int/'
 #DATA_SERVER = 'http://aux.sentinel1.eo.esa.int/'
 
-QC_SERVER = 'https://s1qc.asf.alaska.edu/'
-DATA_SERVER = 'https://s1qc.asf.alaska.edu/'
+QC_SERVER = ORBIT_SERVER
+DATA_SERVER = ORBIT_SERVER
 
 ORBITMAP = [('precise','aux_poeorb', 100),
             ('restituted','aux_resorb', 100)]
 
-OPER_RE = re.compile(r'S1\w_OPER_AUX_(?P<type>\w+)_OPOD_(?P<yr>\d{4})(?P<mo>\d{2})(?P<dy>\d{2})')
+ORBIT_HREF_RE = re.compile(r'^S1.*EOF$')
 
 
 def cmdLineParse():
@@ -61,160 +65,205 @@ def cmdLineParse():
     parser.add_argument("--tag", help="PGE docker image tag (release, version, " +
                                       "or branch) to propagate",
                         default="master", required=False)
-    parser.add_argument("--days_back", help="How far back to query for orbits relative to today",
+    parser.add_argument("--days_back", help="How far back to query for orbits relative to " +
+                                            "today; only applies without crawl state " +
+                                            "(--state_file '')",
                         default="1", required=False)
-    return parser.parse_args()
-
-
-class MyHTMLParser(HTMLParser):
-
-    def __init__(self):
-        HTMLParser.__init__(self)
-        self.fileList = []
-        self.pages = 0
-        self.in_td = False
-        self.in_a = False
-        self.in_ul = False
-
-    def handle_starttag(self, tag, attrs):
-        if tag == 'td':
-            self.in_td = True
-        elif tag == 'a':
-            self.in_a = True
-        elif tag == 'ul':
-            for k,v in attrs:
-                if k == 'class' and v.startswith('pagination'):
-                    self.in_ul = True
-        elif tag == 'li' and self.in_ul:
-            self.pages += 1
-
-    def handle_data(self,data):
-        if self.in_a:
-            if OPER_RE.search(data):
-                self.fileList.append(data.strip())
-
-    def handle_endtag(self, tag):
-        if tag == 'td':
-            self.in_td = False
-            self.in_a = False
-        elif tag == 'a':
-            self.in_a = False
-        elif tag == 'ul' and self.in_ul:
-            self.in_ul = False
-        elif tag == 'html':
-            if self.pages == 0:
-                self.pages = 1
-            else:
-                # decrement page back and page forward list items
-                self.pages -= 2
-
-
-@backoff.on_exception(backoff.expo, requests.exceptions.RequestException,
-                      max_tries=8, max_value=32)
-def session_get(session, url):
-    return session.get(url, verify=False)
-
-
-@backoff.on_exception(backoff.expo, requests.exceptions.RequestException,
-                      max_tries=8, max_value=32)
-def check_orbit(es_url, es_index, id):
-    """Query for orbits with specified input ID."""
-
-    query = {"query":{"bool":{"must":[{"term":{"_id":id}}]}}}
-
-    if es_url.endswith('/'):
-        search_url = '%s%s/_search' % (es_url, es_index)
-    else:
-        search_url = '%s/%s/_search' % (es_url, es_index)
-    #logger.info("search_url: %s" % search_url)
-    r = requests.post(search_url, data=json.dumps(query))
-    if r.status_code == 200:
-        result = r.json()
-        #logger.info(pformat(result))
-        total = result['hits']['total']
-        id = 'NONE' if total == 0 else result['hits']['hits'][0]['_id']
-    else:
-        logger.error("Failed to query %s:\n%s" % (es_url, r.text))
-        logger.error("query: %s" % json.dumps(query, indent=2))
-        logger.error("returned: %s" % r.text)
-        if r.status_code == 404: total, id = 0, 'NONE'
-        else: r.raise_for_status()
-    return total, id
-
-
-def crawl_orbits(dataset_version, days_back):
-    """Crawl for orbit urls."""
+    parser.add_argument("--state_file", help="crawl state file recording the newest " +
+                                             "orbit production time seen per listing",
+                        default=os.path.join(STATE_DIR, "crawl_orbits_state.json"),
+                        required=False)
+    parser.add_argument("--full_resync", help="ignore crawl state and process full listings",
+                        action="store_true", default=False)
+    parser.add_argument("--snapshot_dir", help="directory of listing snapshots; only " +
+                                               "orbits added since the last snapshot are " +
+                                               "processed and removals are reported",
+                        default=SNAPSHOT_DIR, required=False)
+    parser.add_argument("--no_snapshots", help="filter listings on crawl state only",
+                        action="store_true", default=False)
+    parser.add_argument("--start", help="backfill orbits with validity starting at or after " +
+                                        "this date, e.g. 2017-01-01; ignores the crawl state",
+                        required=False)
+    parser.add_argument("--end", help="end (exclusive) of the backfill date range",
+                        required=False)
+    parser.add_argument("--listing_cache_dir", help="directory caching listings for " +
+                                                  "conditional requests",
+                        default=LISTING_CACHE_DIR, required=False)
+    parser.add_argument("--no_listing_cache", help="always fetch and parse full listings",
+                        action="store_true", default=False)
+    parser.add_argument("--id_catalog", help="local catalog of dataset IDs confirmed " +
+                                             "ingested, checked before ES",
+                        default=CATALOG_FILE, required=False)
+    parser.add_argument("--no_id_catalog", help="check all IDs against ES",
+                        action="store_true", default=False)
+    parser.add_argument("--catalog_ttl", help="days before a cataloged ID is checked " +
+                                              "against ES again",
+                        type=float, default=CATALOG_TTL, required=False)
+    parser.add_argument("--mirrors_file", help="JSON file of listing and data server " +
+                                               "mirrors per product type",
+                        default=MIRRORS_FILE, required=False)
+    parser.add_argument("--workers", help="number of listings to fetch concurrently",
+                        type=int, default=4, required=False)
+    parser.add_argument("--max_per_host", help="maximum concurrent requests per server",
+                        type=int, default=4, required=False)
+    parser.add_argument("--batch_size", help="number of missing orbits to ingest per job",
+                        type=int, default=1, required=False)
+    parser.add_argument("--prune_superseded", help="skip RESORBs covered by a POEORB or " +
+                                                 "a newer RESORB",
+                        action="store_true", default=False)
+    parser.add_argument("--quiet", help="do not print every listed orbit",
+                        action="store_true", default=False)
+    parser.add_argument("--chunk_size", help="number of orbit IDs to check per ES query",
+                        type=int, default=500, required=False)
+    parser.add_argument("--async", help="issue ES checks and job submissions concurrently " +
+                                        "from an event loop",
+                        dest="use_async", action="store_true", default=False)
+    inps = parser.parse_args()
+    if (inps.start is None) != (inps.end is None):
+        parser.error("specify both or neither of --start and --end")
+    return inps
+
+
+def parse_orbit_listing(r):
+    """Return list of orbit hrefs in listing response."""
+
+    return [href for orbit, href in iter_listing_links(r, ORBIT_HREF_RE)]
+
+
+def get_orbit_mirrors(mirrors_file=None):
+    """Return tuple of (listing, data) MirrorSets of orbits, ranked by
+    probing when there is a choice."""
+
+    config = load_mirrors(mirrors_file)
+    session = get_session(1)
+    mirrors = (get_mirrors(config, 'orbit', 'listing', QC_SERVER, session),
+               get_mirrors(config, 'orbit', 'data', DATA_SERVER, session))
+    session.close()
+    return mirrors
+
+
+def crawl_orbits(dataset_version, days_back, state=None, full_resync=False, cache=None,
+                 workers=1, max_per_host=4, quiet=False, listing_mirrors=None,
+                 data_mirrors=None, start=None, end=None, snapshots=None):
+    """Crawl for orbit urls.
+
+    Unless full_resync is set, only orbits added to a listing since its
+    last snapshot in snapshots are yielded, or, without a snapshot, those
+    produced after the watermark recorded in state. A listing without a
+    watermark is yielded in full so it is re-checked against ES; without
+    state, only orbits produced within days_back are yielded. Each listing
+    is staged as the new snapshot, unless it is empty.
+    Listings for all ORBITMAP entries are fetched with up to workers threads
+    and processed in ORBITMAP order. With quiet, per-link output is dropped.
+    Listings fail over between listing_mirrors and URLs point at the best
+    of data_mirrors (QC_SERVER and DATA_SERVER by default). With start and
+    end (epoch seconds), only orbits with validity starting in [start, end)
+    are yielded instead, as the listings cannot be queried by date.
+    """
     days_back = int(days_back)
-    date_today = datetime.now()
+    date_today = datetime.utcnow()
     date_delta = timedelta(days = days_back)
     start_date = date_today - date_delta
     mission_type = "sat"
     margin=60.0
     datefmt="%Y%m%dT%H%M%S"
+    min_production = start_date.strftime(datefmt)
     found = False
-    session = requests.Session()
-    for spec in ORBITMAP:
+    session = get_session(workers)
+    limiter = HostLimiter(max_per_host)
+    if listing_mirrors is None: listing_mirrors = MirrorSet([QC_SERVER])
+    if data_mirrors is None: data_mirrors = MirrorSet([DATA_SERVER])
+    def fetch_from(server, spec):
+        query = server + spec[1]
+        r, hrefs = fetch_listing(session, query, parse_orbit_listing, cache, limiter)
+        if r.status_code >= 500: r.raise_for_status()
+        return r, hrefs
+    def fetch(spec):
+        return listing_mirrors.call(lambda server: fetch_from(server, spec))
+    listings = map_ordered(fetch, ORBITMAP, workers)
+    for spec, (r, hrefs) in zip(ORBITMAP, listings):
             results = {}
         #for x in range(days_back):
-            def is_orbit(href):
-                return href and re.compile(r'^S1.*EOF$').search(href)
             #new_delta = timedelta(days = x)
             #new_date = start_date + new_delta
             oType = spec[0]
-            url = QC_SERVER + spec[1]
+            url = listing_mirrors.current + spec[1]
             page_limit = spec[2]
             query = url #+ '/' + date
-            print("The url is: {}".format(query))
+            logger.info("The url is: {}".format(query))
             #logger.info(query)
 
             #logger.info('Querying for {0} orbits'.format(oType))
-            r = session_get(session, query)
-            if r.status_code != 200:
+            if hrefs is None:
                 #logger.info("No orbits found at this url: {}".format(query))
                 continue
             #r.raise_for_status()
             #parser = MyHTMLParser()
             #parser.feed(r.text)
-            parser = BeautifulSoup(r.text, 'html.parser')
-            print("All found links")
-            print(parser.find_all(href=is_orbit))
-            print(len(parser.find_all(href=is_orbit)))
-            for a in parser.find_all(href=is_orbit):
-                print("All links")
-                print(a['href'])
-                m = re.search(r'^(?P<sat>S1[AB])_.*$', a['href'])
-                sat = m.groupdict()['sat']
-                if mission_type != sat:
-                    orbit = os.path.basename(a['href'])
-                    print("The orbit is: ")
-                    print(orbit)
-                    fields = orbit.split('_')
-                    orbit_start_date_time = datetime.strptime(fields[6].replace('V',''), datefmt) + timedelta(seconds=margin)
-                    orbit_stop_date_time = datetime.strptime(fields[7].replace('.EOF',''), datefmt) - timedelta(seconds=margin)
+            metrics.incr('links_listed', len(hrefs))
+            added = None
+            # an empty listing is taken as unavailable (e.g. a maintenance page)
+            # rather than as every orbit being removed, so it is not diffed
+            if len(hrefs) == 0:
+                logger.warning("No orbits listed at {}. Keeping its snapshot.".format(query))
+            elif snapshots is not None and start is None:
+                diff = snapshots.diff("%s/%s" % (dataset_version, spec[1]),
+                                      ["%s-%s" % (os.path.splitext(os.path.basename(href))[0],
+                                                  dataset_version) for href in hrefs])
+                if diff is not None: added = set(diff[0])
+            if not quiet:
+                print("All found links")
+                print(hrefs)
+            logger.info("Found {} links".format(len(hrefs)))
+            for href in hrefs:
+                if not quiet:
+                    print("All links")
+                    print(href)
+                orbit = os.path.basename(href)
+                info = parse_orbit_name(orbit)
+                if info is None:
+                    raise RuntimeError("Failed to parse orbit: {}".format(orbit))
+                if mission_type != info.sat:
+                    if not quiet:
+                        print("The orbit is: ")
+                        print(orbit)
+                    production = format_time(info.creation)
+                    orbit_id = "%s-%s" % (os.path.splitext(orbit)[0], dataset_version)
+                    if start is not None:
+                        if info.start < start or info.start >= end: continue
+                    elif full_resync: pass
+                    elif added is not None:
+                        if orbit_id not in added: continue
+                    else:
+                        if state is None: new = production >= min_production
+                        else: new = state.is_new(spec[1], production, orbit_id)
+                        if not new: continue
                     #results[os.path.splitext(os.path.basename(a['href']))[0]] = f"{url}{a['href']}"
                     found = True
-                    results[orbit] = f"{url}{a['href']}"
-                    print("Adding new key/val")
-                    print(orbit)
-                    print(f"{url}/{a['href']}")
+                    results[orbit] = f"{url}{href}"
+                    if not quiet:
+                        print("Adding new key/val")
+                        print(orbit)
+                        print(f"{url}/{href}")
                     #break
                    #if slc_start_dt >= orbit_start_date_time and slc_end_dt < orbit_stop_date_time:
                     #    results[os.path.splitext(os.path.basename(a['href']))[0]] = f"{url}{a['href']}"
                     #    found = True
                     #    break
-                else: print("Not equal to sat")
+                elif not quiet: print("Not equal to sat")
             #if found: break
             #logger.info("Found {} pages".format(parser.pages))
-            print("Length of results")
-            print(len(results))
+            logger.info("Length of results: {}".format(len(results)))
             for res in list(results):
                 id = "%s-%s" % (os.path.splitext(res)[0], dataset_version)
-                match = OPER_RE.search(res)
-                if not match:
+                info = parse_orbit_name(res)
+                if info is None:
                     raise RuntimeError("Failed to parse orbit: {}".format(res))
-                results[id] = DATA_SERVER + spec[1] + '/' + "{}".format(res)
+                results[id] = data_mirrors.current + spec[1] + '/' + "{}".format(res)
                 #results[id] = os.path.join("https://s1qc.asf.alaska.edu/", "/", "{}.EOF".format(res))
-                print(results[id])
+                if not quiet: print(results[id])
+                if state is not None:
+                    state.advance(spec[1], format_time(info.creation), id)
                 yield id, results[id]
 
     # close session
@@ -250,14 +299,14 @@ def submit_job(id, url, ds_es_url, tag, dataset_version):
             "value": dataset_version,
         },
         {
-            "name": "orbit_url",
+            "name": "orbit_url_opt",
             "from": "value",
-            "value": url,
+            "value": "--orbit_urls",
         },
         {
-            "name": "orbit_file",
+            "name": "orbit_url",
             "from": "value",
-            "value": os.path.basename(url),
+            "value": url,
         },
         {
             "name": "es_dataset_url",
@@ -266,35 +315,232 @@ def submit_job(id, url, ds_es_url, tag, dataset_version):
         }
     ]
     print("submitting orbit ingest job for %s" % id)
-    submit_mozart_job({}, rule,
-        hysdsio={"id": "internal-temporary-wiring",
-                 "params": params,
-                 "job-specification": job_spec},
-        job_name=job_name)
+    with metrics.timer('job_submit'):
+        submit_mozart_job({}, rule,
+            hysdsio={"id": "internal-temporary-wiring",
+                     "params": params,
+                     "job-specification": job_spec},
+            job_name=job_name)
+    metrics.incr('jobs_submitted')
 
 
-def crawl(ds_es_url, dataset_version, tag, days_back):
-    """Crawl for orbits and submit job if they don't exist in ES."""
+def submit_batch_job(ids, urls, ds_es_url, tag, dataset_version):
+    """Submit a single job for dataset generation of a batch of orbits."""
 
-    for id, url in crawl_orbits(dataset_version, days_back):
+    job_spec = "job-s1_orbit_batch_ingest:%s" % tag
+    job_name = "%s-%s-%d" % (job_spec, ids[0], len(ids))
+    job_name = job_name.lstrip('job-')
+
+    #Setup input arguments here
+    rule = {
+        "rule_name": "s1_orbit_batch_ingest",
+        "queue": "factotum-job_worker-large",
+        "priority": 0,
+        "kwargs":'{}'
+    }
+    params = [
+        {
+            "name": "version_opt",
+            "from": "value",
+            "value": "--dataset_version",
+        },
+        {
+            "name": "version",
+            "from": "value",
+            "value": dataset_version,
+        },
+        {
+            "name": "orbit_urls_opt",
+            "from": "value",
+            "value": "--orbit_urls",
+        },
+        {
+            "name": "orbit_urls",
+            "from": "value",
+            "value": ",".join(urls),
+        },
+        {
+            "name": "es_dataset_url",
+            "from": "value",
+            "value": ds_es_url,
+        }
+    ]
+    print("submitting orbit batch ingest job for %d orbits starting at %s" % (len(ids), ids[0]))
+    with metrics.timer('job_submit'):
+        submit_mozart_job({}, rule,
+            hysdsio={"id": "internal-temporary-wiring",
+                     "params": params,
+                     "job-specification": job_spec},
+            job_name=job_name)
+    metrics.incr('jobs_submitted')
+
+
+def get_superseded(ds_es_url, dataset_version, orbits, missing):
+    """Return set of IDs of missing RESORBs superseded by a listed or
+    ingested POEORB or by a newer RESORB."""
+
+    candidates = [(id, url) for id, url in orbits if id in missing]
+    resorb_starts = [parse_orbit_name(id).start for id, url in candidates
+                     if parse_orbit_name(id).type == 'RESORB']
+    if len(resorb_starts) == 0: return set()
+    ingested = get_ingested_orbits(ds_es_url, dataset_version, ['POEORB'],
+                                   since=min(resorb_starts))
+    kept, skipped = prune_superseded(candidates, [id for id, url in orbits], ingested)
+    return set([id for id, url in candidates]) - set([id for id, url in kept])
+
+
+def get_job_batches(orbits, missing, pruned=(), batch_size=1):
+    """Log status of each orbit. Return list of (ids, urls) tuples of
+    missing orbits to submit, one per job."""
+
+    batches = []
+    batch = []
+    for id, url in orbits:
         #logger.info("%s: %s" % (id, url))
-        total, found_id = check_orbit(ds_es_url, "grq", id)
-        if total > 0:
+        if id not in missing:
             logger.info("Found %s." % id)
             #prods_found.append(acq_id)
-        else:
+        elif id in pruned:
+            logger.info("Missing %s. Skipping superseded orbit." % id)
+        elif batch_size <= 1:
             logger.info("Missing %s. Submitting job." % id)
             #prods_missing.append(acq_id)
-            submit_job(id, url, ds_es_url, tag, dataset_version)
+            batches.append(((id,), (url,)))
+        else:
+            logger.info("Missing %s. Adding to batch." % id)
+            batch.append((id, url))
+            if len(batch) == batch_size:
+                batches.append(tuple(zip(*batch)))
+                batch = []
+    if len(batch) > 0: batches.append(tuple(zip(*batch)))
+    return batches
+
+
+def submit_orbit_job(ids, urls, ds_es_url, tag, dataset_version, batch_size=1):
+    """Submit ingest job for a batch returned by get_job_batches()."""
+
+    if batch_size <= 1: submit_job(ids[0], urls[0], ds_es_url, tag, dataset_version)
+    else: submit_batch_job(ids, urls, ds_es_url, tag, dataset_version)
+
+
+def process_orbits(orbits, missing, ds_es_url, tag, dataset_version, batch_size=1,
+                   prune=False, state=None, snapshots=None, workers=1):
+    """Submit ingest jobs for the missing IDs of listed (id, url) orbits with
+    up to workers threads, skipping superseded RESORBs with prune. Only once
+    all were submitted, save the watermarks in state and the staged
+    snapshots. Return dict of results."""
+
+    pruned = get_superseded(ds_es_url, dataset_version, orbits, missing) if prune else set()
+    batches = get_job_batches(orbits, missing, pruned, batch_size)
+    map_ordered(lambda batch: submit_orbit_job(batch[0], batch[1], ds_es_url, tag,
+                                               dataset_version, batch_size),
+                batches, workers)
+
+    # only advance watermarks and snapshots once all jobs were submitted
+    if state is not None: state.save()
+    result = {'skipped': len(pruned), 'jobs_submitted': len(batches)}
+    if snapshots is not None:
+        result['removed'] = snapshots.removed
+        snapshots.save()
+    return result
+
+
+def crawl(ds_es_url, dataset_version, tag, days_back, chunk_size=500,
+          state_file=None, full_resync=False, listing_cache_dir=None, workers=1,
+          max_per_host=4, batch_size=1, quiet=False, prune=False, catalog_file=None,
+          catalog_ttl=CATALOG_TTL, mirrors_file=None, start=None, end=None,
+          snapshot_dir=None):
+    """Crawl for orbits and submit job if they don't exist in ES.
+
+    With a batch_size greater than 1, missing orbits are grouped into one
+    batch ingest job per batch_size orbits. With prune, missing RESORBs
+    superseded by a listed or ingested POEORB or a newer RESORB are skipped.
+    With a catalog_file, only orbits not confirmed ingested within the last
+    catalog_ttl days are checked against ES. Mirrors are read from
+    mirrors_file. With start and end, orbits with validity starting in
+    [start, end) are backfilled without touching the crawl state. With a
+    snapshot_dir, only orbits added to the listings since their snapshots
+    are processed and removed ones are reported.
+    """
+
+    state = CrawlState(state_file) if state_file and start is None else None
+    snapshots = ListingSnapshots(snapshot_dir) if snapshot_dir and start is None else None
+    cache = ListingCache(listing_cache_dir) if listing_cache_dir else None
+    orbits = list(crawl_orbits(dataset_version, days_back, state, full_resync, cache,
+                               workers, max_per_host, quiet,
+                               *get_orbit_mirrors(mirrors_file), start=start, end=end,
+                               snapshots=snapshots))
+    ids = [id for id, url in orbits]
+    check = lambda ids: check_orbits(ds_es_url, "grq", ids, chunk_size)
+    if catalog_file:
+        catalog = IdCatalog(catalog_file, catalog_ttl)
+        missing = catalog.find_missing(dataset_version, ids, check)
+        catalog.close()
+    else: missing = check(ids)
+    metrics.incr('found', len(orbits) - len(missing))
+    metrics.incr('missing', len(missing))
+    process_orbits(orbits, missing, ds_es_url, tag, dataset_version, batch_size, prune,
+                   state, snapshots)
+
+
+async def crawl_async(ds_es_url, dataset_version, tag, days_back, chunk_size=500,
+                      state_file=None, full_resync=False, listing_cache_dir=None, workers=1,
+                      max_per_host=4, batch_size=1, quiet=False, prune=False,
+                      catalog_file=None, catalog_ttl=CATALOG_TTL, mirrors_file=None,
+                      start=None, end=None, snapshot_dir=None):
+    """Same as crawl(), but ES chunks are checked concurrently from an event
+    loop and jobs are submitted concurrently, with at most max_per_host ES
+    queries and job submissions in flight."""
+
+    limiter = EndpointLimiter({'qc': 1, 'es': max_per_host, 'mozart': 1})
+    try:
+        state = CrawlState(state_file) if state_file and start is None else None
+        snapshots = ListingSnapshots(snapshot_dir) if snapshot_dir and start is None else None
+        cache = ListingCache(listing_cache_dir) if listing_cache_dir else None
+        mirrors = await limiter.run('qc', get_orbit_mirrors, mirrors_file)
+        orbits = await limiter.run('qc', lambda: list(crawl_orbits(
+                                   dataset_version, days_back, state, full_resync, cache,
+                                   workers, max_per_host, quiet, *mirrors,
+                                   start=start, end=end, snapshots=snapshots)))
+        ids = [id for id, url in orbits]
+        catalog = IdCatalog(catalog_file, catalog_ttl) if catalog_file else None
+        known = catalog.known(dataset_version, ids) if catalog else set()
+        unknown = [id for id in ids if id not in known]
+        missing = set().union(*(await limiter.map(
+            'es', lambda chunk: check_orbits(ds_es_url, "grq", chunk, chunk_size),
+            chunks(unknown, chunk_size))))
+        if catalog:
+            catalog.add(dataset_version, [id for id in unknown if id not in missing])
+            catalog.close()
+        metrics.incr('found', len(orbits) - len(missing))
+        metrics.incr('missing', len(missing))
+        await limiter.run('mozart', process_orbits, orbits, missing, ds_es_url, tag,
+                          dataset_version, batch_size, prune, state, snapshots,
+                          max_per_host)
+    finally: limiter.shutdown()
 
 
 if __name__ == '__main__':
     inps = cmdLineParse()
-    try: status = crawl(inps.ds_es_url, inps.dataset_version, inps.tag, inps.days_back)
+    kwargs = dict(ds_es_url=inps.ds_es_url, dataset_version=inps.dataset_version,
+                  tag=inps.tag, days_back=inps.days_back, chunk_size=inps.chunk_size,
+                  state_file=inps.state_file, full_resync=inps.full_resync,
+                  listing_cache_dir=None if inps.no_listing_cache else inps.listing_cache_dir,
+                  workers=inps.workers, max_per_host=inps.max_per_host,
+                  batch_size=inps.batch_size, quiet=inps.quiet, prune=inps.prune_superseded,
+                  catalog_file=None if inps.no_id_catalog else inps.id_catalog,
+                  catalog_ttl=inps.catalog_ttl, mirrors_file=inps.mirrors_file,
+                  start=None if inps.start is None else parse_query_time(inps.start),
+                  end=None if inps.end is None else parse_query_time(inps.end),
+                  snapshot_dir=None if inps.no_snapshots else inps.snapshot_dir)
+    try:
+        if inps.use_async: status = asyncio.run(crawl_async(**kwargs))
+        else: status = crawl(**kwargs)
     except Exception as e:
         with open('_alt_error.txt', 'w') as f:
             f.write("%s\n" % str(e))
         with open('_alt_traceback.txt', 'w') as f:
             f.write("%s\n" % traceback.format_exc())
         raise
+    finally: metrics.write()
     sys.exit(status)
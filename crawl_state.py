@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Persistent crawl state (high-water marks) for the Sentinel1 QC crawlers.
+"""
+
+import os, json, logging, tempfile
+
+
+# set logger
+logger = logging.getLogger('crawl_state')
+logger.setLevel(logging.INFO)
+
+
+# default location for crawler state files; override via environment to
+# point at storage that persists across job containers (the job-specs mount
+# the worker's ~/.s1_qc_ingest here)
+STATE_DIR = os.environ.get('S1_QC_STATE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.s1_qc_ingest'))
+
+
+def atomic_write(path, write):
+    """Call write(tmp_file) on a temporary file unique to this writer in the
+    directory of path and rename it to path, so concurrent jobs sharing
+    STATE_DIR never see or clobber each other's partial files."""
+
+    state_dir = os.path.dirname(os.path.abspath(path))
+    os.makedirs(state_dir, 0o755, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=state_dir, prefix="%s." % os.path.basename(path),
+                                    suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_file)
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, path)
+    except:
+        os.unlink(tmp_file)
+        raise
+
+
+class CrawlState(object):
+    """High-water mark store backed by a local JSON file.
+
+    For each listing key the newest production timestamp seen is recorded
+    along with the IDs produced at exactly that timestamp, so ties at the
+    watermark are not reprocessed on the next run.
+    """
+
+    def __init__(self, state_file):
+        self.state_file = os.path.abspath(state_file)
+        self.state = {}
+        if os.path.exists(self.state_file):
+            with open(self.state_file) as f:
+                self.state = json.load(f)
+            logger.info("loaded crawl state from %s" % self.state_file)
+
+    def get(self, key):
+        """Return tuple of (watermark, set of IDs seen at watermark) for key."""
+
+        entry = self.state.get(key, {})
+        return entry.get('watermark'), set(entry.get('seen', []))
+
+    def is_new(self, key, production, id):
+        """Return True if ID produced at production timestamp is past the
+        watermark, or if key has no watermark yet."""
+
+        watermark, seen = self.get(key)
+        if watermark is None: return True
+        if production > watermark: return True
+        return production == watermark and id not in seen
+
+    def advance(self, key, production, id):
+        """Move watermark for key forward to include ID."""
+
+        entry = self.state.setdefault(key, {'watermark': None, 'seen': []})
+        if entry['watermark'] is None or production > entry['watermark']:
+            entry['watermark'] = production
+            entry['seen'] = [id]
+        elif production == entry['watermark'] and id not in entry['seen']:
+            entry['seen'].append(id)
+
+    def save(self):
+        """Atomically write state to disk."""
+
+        def write(tmp_file):
+            with open(tmp_file, 'w') as f:
+                json.dump(self.state, f, indent=2, sort_keys=True)
+        atomic_write(self.state_file, write)
+        logger.info("saved crawl state to %s" % self.state_file)
@@ -1,15 +1,19 @@
 #!/usr/bin/env python
 """
-Create a HySDS dataset from a Sentinel1 calibration tar file.
+Create HySDS datasets from Sentinel1 calibration tar files.
 """
 
 from builtins import str
-import os, sys, time, re, json, requests, shutil, logging, traceback, argparse, backoff
-from requests.packages.urllib3.exceptions import (InsecureRequestWarning,
-                                                  InsecurePlatformWarning)
+import os, sys, time, re, json, shutil, logging, traceback, argparse, functools
 from datetime import datetime, timedelta
 from pprint import pformat
 
+import es_client
+from dataset_utils import PLACEMENTS, create_datasets, expand_inputs, place_file, write_results
+from metrics import metrics
+from qc_common import file_checksum
+from qc_filenames import parse_cal_name, to_datetime
+
 
 # set logger
 log_format = "[%(asctime)s: %(levelname)s/%(funcName)s] %(message)s"
@@ -26,44 +30,13 @@ logger.addFilter(LogFilter())
 
 
 # regexes
-AUX_RE = re.compile(r'^(?P<sat>S1.+?)_AUX_(?P<type>.*?)_V(?P<vs_yr>\d{4})(?P<vs_mo>\d{2})(?P<vs_dy>\d{2})T(?P<vs_hh>\d{2})(?P<vs_mm>\d{2})(?P<vs_ss>\d{2})_G(?P<cr_yr>\d{4})(?P<cr_mo>\d{2})(?P<cr_dy>\d{2})T(?P<cr_hh>\d{2})(?P<cr_mm>\d{2})(?P<cr_ss>\d{2})-(?P<version>.+)$')
 PLATFORM_RE = re.compile(r'S1(.+?)_')
 
 
-@backoff.on_exception(backoff.expo, requests.exceptions.RequestException,
-                      max_tries=8, max_value=32)
-def check_cal(es_url, es_index, id):
-    """Query for calibration file with specified input ID."""
-
-    query = {
-        "query":{
-            "bool":{
-                "must": [
-                    { "term": { "_id": id } },
-                ]
-            }
-        },
-        "fields": [],
-    }
+def check_cals(es_url, es_index, ids, chunk_size=500):
+    """Query for calibration files with specified input IDs in chunks. Return set of missing IDs."""
 
-    if es_url.endswith('/'):
-        search_url = '%s%s/_search' % (es_url, es_index)
-    else:
-        search_url = '%s/%s/_search' % (es_url, es_index)
-    #logger.info("search_url: %s" % search_url)
-    r = requests.post(search_url, data=json.dumps(query))
-    if r.status_code == 200:
-        result = r.json()
-        #logger.info(pformat(result))
-        total = result['hits']['total']
-        id = 'NONE' if total == 0 else result['hits']['hits'][0]['_id']
-    else:
-        logger.error("Failed to query %s:\n%s" % (es_url, r.text))
-        logger.error("query: %s" % json.dumps(query, indent=2))
-        logger.error("returned: %s" % r.text)
-        if r.status_code == 404: total, id = 0, 'NONE'
-        else: r.raise_for_status()
-    return total, id
+    return es_client.find_ids(es_url, es_index, ids, chunk_size)
 
 
 def get_dataset_json(met, version):
@@ -76,50 +49,54 @@ def get_dataset_json(met, version):
     }
 
 
-def create_dataset(ds, met, cal_tar_file, root_ds_dir="."):
+def create_dataset(ds, met, cal_tar_file, root_ds_dir=".", placement="auto"):
     """Create dataset. Return tuple of (dataset ID, dataset dir)."""
 
-    # create dataset dir
-    id = met['data_product_name']
-    root_ds_dir = os.path.abspath(root_ds_dir)
-    ds_dir = os.path.join(root_ds_dir, id)
-    if not os.path.isdir(ds_dir): os.makedirs(ds_dir, 0o755)
-
-    # dump dataset and met JSON
-    ds_file = os.path.join(ds_dir, "%s.dataset.json" % id)
-    met_file = os.path.join(ds_dir, "%s.met.json" % id)
-    with open(ds_file, 'w') as f:
-        json.dump(ds, f, indent=2, sort_keys=True)
-    with open(met_file, 'w') as f:
-        json.dump(met, f, indent=2, sort_keys=True)
-
-    # copy calibration tar file
-    shutil.copy(cal_tar_file, ds_dir)
+    with metrics.timer('dataset_write'):
+        # create dataset dir
+        id = met['data_product_name']
+        root_ds_dir = os.path.abspath(root_ds_dir)
+        ds_dir = os.path.join(root_ds_dir, id)
+        if not os.path.isdir(ds_dir): os.makedirs(ds_dir, 0o755)
+
+        # dump dataset and met JSON
+        ds_file = os.path.join(ds_dir, "%s.dataset.json" % id)
+        met_file = os.path.join(ds_dir, "%s.met.json" % id)
+        with open(ds_file, 'w') as f:
+            json.dump(ds, f, indent=2, sort_keys=True)
+        with open(met_file, 'w') as f:
+            json.dump(met, f, indent=2, sort_keys=True)
+
+        # place calibration tar file
+        place_file(cal_tar_file, ds_dir, placement)
+    metrics.incr('datasets_created')
+    metrics.incr('bytes_placed', os.path.getsize(os.path.join(ds_dir, os.path.basename(cal_tar_file))))
 
     logger.info("created dataset %s" % ds_dir)
     return id, ds_dir
 
 
-def create_cal_ds(cal_tar_file, ds_es_url, version="v1.1"):
-    """Create calibration dataset."""
+def create_cal_ds(cal_tar_file, ds_es_url, version="v1.1", dedup=True, placement="auto",
+                  checksum=None):
+    """Create calibration dataset. checksum is a tuple of (size, sha256 hex
+    digest) of cal_tar_file, computed here if not given."""
 
     # extract info from calibration tar filename
     cal_tar_file_base = os.path.basename(cal_tar_file)
     id = "%s-%s" % (os.path.splitext(cal_tar_file_base)[0], version)
-    match = AUX_RE.search(id)
-    if not match:
+    info = parse_cal_name(id)
+    if info is None:
         raise RuntimeError("Failed to extract info from calibration tar filename %s." % id)
-    info = match.groupdict()
 
     # get dates
-    create_dt = datetime(*[int(info[i]) for i in ['cr_yr', 'cr_mo', 'cr_dy', 'cr_hh', 'cr_mm', 'cr_ss']])
-    valid_start = datetime(*[int(info[i]) for i in ['vs_yr', 'vs_mo', 'vs_dy', 'vs_hh', 'vs_mm', 'vs_ss']])
+    create_dt = to_datetime(info.creation)
+    valid_start = to_datetime(info.start)
     logger.info("create date:         %s" % create_dt)
     logger.info("validity start date: %s" % valid_start)
 
     # get sat/platform and sensor
     sensor = "SAR-C Sentinel1"
-    sat = info['sat']
+    sat = info.sat
     if sat == "S1A": platform = "Sentinel-1A"
     elif sat == "S1B": platform = "Sentinel-1B"
     else: raise RuntimeError("Failed to recognize sat: %s" % sat)
@@ -129,13 +106,17 @@ def create_cal_ds(cal_tar_file, ds_es_url, version="v1.1"):
 
     # get calibration tar product type
     typ = "auxiliary"
-    aux_type = info['type']
+    aux_type = info.type
     if aux_type == "CAL": dataset = "S1-AUX_CAL"
     else: raise RuntimeError("Failed to recognize auxiliary type: %s" % aux_type)
     logger.info("typ: %s" % typ)
     logger.info("aux_type: %s" % aux_type)
     logger.info("dataset: %s" % dataset)
 
+    # get size and checksum
+    if checksum is None: checksum = file_checksum(cal_tar_file)
+    size, sha256 = checksum
+
     # get metadata json
     met = {
         "creationTime": create_dt.isoformat('T'),
@@ -145,6 +126,8 @@ def create_cal_ds(cal_tar_file, ds_es_url, version="v1.1"):
         "platform": platform,
         "dataset": dataset,
         "archive_filename": cal_tar_file_base,
+        "archive_size": size,
+        "archive_sha256": sha256,
     }
     logger.info("met: %s" % json.dumps(met, indent=2, sort_keys=True))
 
@@ -153,28 +136,51 @@ def create_cal_ds(cal_tar_file, ds_es_url, version="v1.1"):
     logger.info("dataset: %s" % json.dumps(ds, indent=2, sort_keys=True))
 
     # dedup dataset
-    total, found_id = check_cal(ds_es_url, "grq", id)
-    logger.info("total, found_id: %s %s" % (total, found_id))
-    if total > 0:
-        logger.info("Found %s in %s. Dedupping dataset." % (id, ds_es_url))
-        return
+    if dedup:
+        missing = check_cals(ds_es_url, "grq", [id])
+        logger.info("missing: %s" % sorted(missing))
+        if id not in missing:
+            logger.info("Found %s in %s. Dedupping dataset." % (id, ds_es_url))
+            return
 
     # create dataset
-    id, ds_dir = create_dataset(ds, met, cal_tar_file)
+    id, ds_dir = create_dataset(ds, met, cal_tar_file, placement=placement)
+
+
+def is_cal_file(path):
+    """Return True if path is named like a calibration tar file."""
+
+    return parse_cal_name(os.path.splitext(os.path.basename(path))[0]) is not None
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("cal_tar_file", help="Sentinel1 calibration tar file")
+    parser.add_argument("cal_tar_file", help="Sentinel1 calibration tar files, " +
+                                             "directories of them or globs",
+                        nargs='+')
     parser.add_argument("ds_es_url", help="ElasticSearch URL for datasets, e.g. " +
                         "http://aria-products.jpl.nasa.gov:9200")
     parser.add_argument("--dataset_version", help="dataset version",
                         default="v1.1", required=False)
+    parser.add_argument("--placement", help="how to place the calibration tar file " +
+                                            "into the dataset",
+                        choices=sorted(PLACEMENTS), default="auto", required=False)
+    parser.add_argument("--workers", help="number of processes creating datasets from " +
+                                          "calibration tar files",
+                        type=int, default=1, required=False)
     args = parser.parse_args()
-    try: create_cal_ds(args.cal_tar_file, args.ds_es_url, args.dataset_version)
+    try:
+        cal_tar_files = expand_inputs(args.cal_tar_file, is_cal_file)
+        create = functools.partial(create_cal_ds, ds_es_url=args.ds_es_url,
+                                   version=args.dataset_version, dedup=False,
+                                   placement=args.placement)
+        write_results(create_datasets(cal_tar_files, args.dataset_version,
+                                      lambda ids: check_cals(args.ds_es_url, "grq", ids),
+                                      create, args.workers))
     except Exception as e:
         with open('_alt_error.txt', 'a') as f:
             f.write("%s\n" % str(e))
         with open('_alt_traceback.txt', 'a') as f:
             f.write("%s\n" % traceback.format_exc())
         raise
+    finally: metrics.write()
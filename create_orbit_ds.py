@@ -1,13 +1,18 @@
 #!/usr/bin/env python
 """
-Create a HySDS dataset from a Sentinel1 precise or restituted orbit.
+Create HySDS datasets from Sentinel1 precise or restituted orbits.
 """
 
 from builtins import str
-import os, sys, time, re, json, requests, shutil, logging, traceback, argparse
+import os, sys, time, re, json, shutil, logging, traceback, argparse, functools
 from datetime import datetime, timedelta
 
-from crawl_orbits import check_orbit
+import es_client
+from dataset_utils import PLACEMENTS, create_datasets, expand_inputs, place_file, write_results
+from metrics import metrics
+from mirrors import MIRRORS_FILE
+from qc_common import ORBIT_SERVER, file_checksum
+from qc_filenames import parse_orbit_name, to_datetime
 
 # set logger
 log_format = "[%(asctime)s: %(levelname)s/%(funcName)s] %(message)s"
@@ -24,10 +29,15 @@ logger.addFilter(LogFilter())
 
 
 # regexes
-ORBIT_RE = re.compile(r'^(?P<sat>S1.+?)_OPER_AUX_(?P<type>.*?)_OPOD_(?P<cr_yr>\d{4})(?P<cr_mo>\d{2})(?P<cr_dy>\d{2})T(?P<cr_hh>\d{2})(?P<cr_mm>\d{2})(?P<cr_ss>\d{2})_V(?P<vs_yr>\d{4})(?P<vs_mo>\d{2})(?P<vs_dy>\d{2})T(?P<vs_hh>\d{2})(?P<vs_mm>\d{2})(?P<vs_ss>\d{2})_(?P<ve_yr>\d{4})(?P<ve_mo>\d{2})(?P<ve_dy>\d{2})T(?P<ve_hh>\d{2})(?P<ve_mm>\d{2})(?P<ve_ss>\d{2})-(?P<version>.+)$')
 PLATFORM_RE = re.compile(r'S1(.+?)_')
 
 
+def check_orbits(es_url, es_index, ids, chunk_size=500):
+    """Query for orbits with specified input IDs in chunks. Return set of missing IDs."""
+
+    return es_client.find_ids(es_url, es_index, ids, chunk_size)
+
+
 def get_dataset_json(met, version):
     """Generated HySDS dataset JSON from met JSON."""
 
@@ -39,52 +49,56 @@ def get_dataset_json(met, version):
     }
 
 
-def create_dataset(ds, met, orbit_file, root_ds_dir="."):
+def create_dataset(ds, met, orbit_file, root_ds_dir=".", placement="auto"):
     """Create dataset. Return tuple of (dataset ID, dataset dir)."""
 
-    # create dataset dir
-    id = met['data_product_name']
-    root_ds_dir = os.path.abspath(root_ds_dir)
-    ds_dir = os.path.join(root_ds_dir, id)
-    if not os.path.isdir(ds_dir): os.makedirs(ds_dir, 0o755)
-
-    # dump dataset and met JSON
-    ds_file = os.path.join(ds_dir, "%s.dataset.json" % id)
-    met_file = os.path.join(ds_dir, "%s.met.json" % id)
-    with open(ds_file, 'w') as f:
-        json.dump(ds, f, indent=2, sort_keys=True)
-    with open(met_file, 'w') as f:
-        json.dump(met, f, indent=2, sort_keys=True)
-
-    # copy orbit file
-    shutil.copy(orbit_file, ds_dir)
+    with metrics.timer('dataset_write'):
+        # create dataset dir
+        id = met['data_product_name']
+        root_ds_dir = os.path.abspath(root_ds_dir)
+        ds_dir = os.path.join(root_ds_dir, id)
+        if not os.path.isdir(ds_dir): os.makedirs(ds_dir, 0o755)
+
+        # dump dataset and met JSON
+        ds_file = os.path.join(ds_dir, "%s.dataset.json" % id)
+        met_file = os.path.join(ds_dir, "%s.met.json" % id)
+        with open(ds_file, 'w') as f:
+            json.dump(ds, f, indent=2, sort_keys=True)
+        with open(met_file, 'w') as f:
+            json.dump(met, f, indent=2, sort_keys=True)
+
+        # place orbit file
+        place_file(orbit_file, ds_dir, placement)
+    metrics.incr('datasets_created')
+    metrics.incr('bytes_placed', os.path.getsize(os.path.join(ds_dir, os.path.basename(orbit_file))))
 
     logger.info("created dataset %s" % ds_dir)
     return id, ds_dir
 
 
-def create_orbit_ds(orbit_file, ds_es_url, version="v1.1"):
-    """Create orbit dataset."""
+def create_orbit_ds(orbit_file, ds_es_url, version="v1.1", dedup=True, placement="auto",
+                    checksum=None):
+    """Create orbit dataset. checksum is a tuple of (size, sha256 hex digest)
+    of orbit_file, computed here if not given."""
 
     # extract info from orbit filename
     orbit_file_base = os.path.basename(orbit_file)
     id = "%s-%s" % (os.path.splitext(orbit_file_base)[0], version)
-    match = ORBIT_RE.search(id)
-    if not match:
+    info = parse_orbit_name(id)
+    if info is None:
         raise RuntimeError("Failed to extract info from orbit filename %s." % id)
-    info = match.groupdict()
 
     # get dates
-    create_dt = datetime(*[int(info[i]) for i in ['cr_yr', 'cr_mo', 'cr_dy', 'cr_hh', 'cr_mm', 'cr_ss']])
-    valid_start = datetime(*[int(info[i]) for i in ['vs_yr', 'vs_mo', 'vs_dy', 'vs_hh', 'vs_mm', 'vs_ss']])
-    valid_end = datetime(*[int(info[i]) for i in ['ve_yr', 've_mo', 've_dy', 've_hh', 've_mm', 've_ss']])
+    create_dt = to_datetime(info.creation)
+    valid_start = to_datetime(info.start)
+    valid_end = to_datetime(info.stop)
     logger.info("create date:         %s" % create_dt)
     logger.info("validity start date: %s" % valid_start)
     logger.info("validity end date:   %s" % valid_end)
 
     # get sat/platform and sensor
     sensor = "SAR-C Sentinel1"
-    sat = info['sat']
+    sat = info.sat
     if sat == "S1A": platform = "Sentinel-1A"
     elif sat == "S1B": platform = "Sentinel-1B"
     else: raise RuntimeError("Failed to recognize sat: %s" % sat)
@@ -94,7 +108,7 @@ def create_orbit_ds(orbit_file, ds_es_url, version="v1.1"):
 
     # get orbit product type
     typ = "orbit"
-    orbit_type = info['type']
+    orbit_type = info.type
     if orbit_type == "POEORB": dataset = "S1-AUX_POEORB"
     elif orbit_type == "RESORB": dataset = "S1-AUX_RESORB"
     else: raise RuntimeError("Failed to recognize orbit type: %s" % orbit_type)
@@ -102,6 +116,10 @@ def create_orbit_ds(orbit_file, ds_es_url, version="v1.1"):
     logger.info("orbit_type: %s" % orbit_type)
     logger.info("dataset: %s" % dataset)
 
+    # get size and checksum
+    if checksum is None: checksum = file_checksum(orbit_file)
+    size, sha256 = checksum
+
     # get metadata json
     met = {
         "creationTime": create_dt.isoformat('T'),
@@ -112,6 +130,8 @@ def create_orbit_ds(orbit_file, ds_es_url, version="v1.1"):
         "platform": platform,
         "dataset": dataset,
         "archive_filename": orbit_file_base,
+        "archive_size": size,
+        "archive_sha256": sha256,
     }
     logger.info("met: %s" % json.dumps(met, indent=2, sort_keys=True))
 
@@ -120,28 +140,99 @@ def create_orbit_ds(orbit_file, ds_es_url, version="v1.1"):
     logger.info("dataset: %s" % json.dumps(ds, indent=2, sort_keys=True))
 
     # dedup dataset
-    total, found_id = check_orbit(ds_es_url, "grq", id)
-    logger.info("total, found_id: %s %s" % (total, found_id))
-    if total > 0:
-        logger.info("Found %s in %s. Dedupping dataset." % (id, ds_es_url))
-        return
+    if dedup:
+        missing = check_orbits(ds_es_url, "grq", [id])
+        logger.info("missing: %s" % sorted(missing))
+        if id not in missing:
+            logger.info("Found %s in %s. Dedupping dataset." % (id, ds_es_url))
+            return
 
     # create dataset
-    id, ds_dir = create_dataset(ds, met, orbit_file)
+    id, ds_dir = create_dataset(ds, met, orbit_file, placement=placement)
+
+
+def create_orbit_datasets(orbit_urls, ds_es_url, version="v1.1", mirrors_file=MIRRORS_FILE):
+    """Download orbits and create datasets for those not ingested yet,
+    failing over to the orbit data mirrors in mirrors_file."""
+
+    # only needed to download, not to create datasets from local files
+    from download import download
+    from listing import get_session
+    from mirrors import get_mirrors, load_mirrors
+
+    # dedup all orbits with a single query
+    ids = {}
+    for url in orbit_urls:
+        ids[url] = "%s-%s" % (os.path.splitext(os.path.basename(url))[0], version)
+    missing = check_orbits(ds_es_url, "grq", list(ids.values()))
+    metrics.incr('found', len(ids) - len(missing))
+    metrics.incr('missing', len(missing))
+    logger.info("%d of %d orbits missing" % (len(missing), len(ids)))
+
+    # create datasets and keep going on failures
+    session = get_session(1)
+    data_mirrors = get_mirrors(load_mirrors(mirrors_file), 'orbit', 'data', ORBIT_SERVER)
+    failed = []
+    for url in orbit_urls:
+        if ids[url] not in missing:
+            logger.info("Found %s in %s. Dedupping dataset." % (ids[url], ds_es_url))
+            continue
+        try:
+            orbit_file = os.path.basename(url)
+            checksum = data_mirrors.with_failover(
+                url, lambda url: download(url, orbit_file, session))
+            create_orbit_ds(orbit_file, ds_es_url, version, dedup=False, placement="move",
+                            checksum=checksum)
+        except Exception as e:
+            logger.error("Failed to create dataset for %s: %s" % (url, str(e)))
+            failed.append(url)
+    if len(failed) > 0:
+        raise RuntimeError("Failed to create datasets for %d of %d orbits: %s" %
+                           (len(failed), len(orbit_urls), ", ".join(failed)))
+
+
+def is_orbit_file(path):
+    """Return True if path is named like an orbit file."""
+
+    return parse_orbit_name(os.path.splitext(os.path.basename(path))[0]) is not None
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("orbit_file", help="Sentinel1 precise/restituted orbit file")
+    parser.add_argument("orbit_file", help="Sentinel1 precise/restituted orbit files, " +
+                                           "directories of them or globs",
+                        nargs='*')
     parser.add_argument("ds_es_url", help="ElasticSearch URL for datasets, e.g. " +
                         "http://aria-products.jpl.nasa.gov:9200")
     parser.add_argument("--dataset_version", help="dataset version",
                         default="v1.1", required=False)
+    parser.add_argument("--orbit_urls", help="comma-separated orbit URLs to download " +
+                                             "and ingest instead of orbit_file",
+                        required=False)
+    parser.add_argument("--placement", help="how to place the orbit file into the dataset",
+                        choices=sorted(PLACEMENTS), default="auto", required=False)
+    parser.add_argument("--workers", help="number of processes creating datasets from " +
+                                          "orbit files",
+                        type=int, default=1, required=False)
     args = parser.parse_args()
-    try: create_orbit_ds(args.orbit_file, args.ds_es_url, args.dataset_version)
+    if (len(args.orbit_file) == 0) == (args.orbit_urls is None):
+        parser.error("specify exactly one of orbit_file or --orbit_urls")
+    try:
+        if args.orbit_urls is not None:
+            create_orbit_datasets(args.orbit_urls.split(','), args.ds_es_url,
+                                  args.dataset_version)
+        else:
+            orbit_files = expand_inputs(args.orbit_file, is_orbit_file)
+            create = functools.partial(create_orbit_ds, ds_es_url=args.ds_es_url,
+                                       version=args.dataset_version, dedup=False,
+                                       placement=args.placement)
+            write_results(create_datasets(orbit_files, args.dataset_version,
+                                          lambda ids: check_orbits(args.ds_es_url, "grq", ids),
+                                          create, args.workers))
     except Exception as e:
         with open('_alt_error.txt', 'a') as f:
             f.write("%s\n" % str(e))
         with open('_alt_traceback.txt', 'a') as f:
             f.write("%s\n" % traceback.format_exc())
         raise
+    finally: metrics.write()
@@ -7,10 +7,28 @@ from __future__ import print_function
 
 import os, sys, json, requests, argparse
 from datetime import datetime, timedelta
-import argparse
 
-from hysds_commons.job_utils import submit_mozart_job
-from hysds.celery import app
+from qc_common import submit_mozart_job
+
+
+def submit_crawler_job(job_spec, params, job_name=None):
+    """Submit job_spec with list of (name, value) params to Mozart."""
+
+    if job_name is None: job_name = job_spec.lstrip('job-')
+
+    #Setup input arguments here
+    rule = {
+        "rule_name": job_spec.lstrip('job-'),
+        "queue": "factotum-job_worker-small",
+        "priority": 0,
+        "kwargs":'{}'
+    }
+    params = [{"name": name, "from": "value", "value": value} for name, value in params]
+    return submit_mozart_job({}, rule,
+        hysdsio={"id": "internal-temporary-wiring",
+                 "params": params,
+                 "job-specification": job_spec},
+        job_name=job_name, enable_dedup=False)
 
 
 if __name__ == "__main__":
@@ -26,69 +44,23 @@ if __name__ == "__main__":
     parser.add_argument("--tag", help="PGE docker image tag (release, version, " +
                                       "or branch) to propagate",
                         default="master", required=False)
-    parser.add_argument("--type", help="Sentinel-1 QC file type to crawl",
-                        choices=['orbit', 'calibration'], required=True)
+    parser.add_argument("--type", help="Sentinel-1 QC file type to crawl; all crawls " +
+                                       "every type in a single job",
+                        choices=['orbit', 'calibration', 'all'], required=True)
     parser.add_argument("--days_back", help="How far back to query for orbits relative to today",
                         default="1", required=False)
     args = parser.parse_args()
 
-    ds_es_url = args.ds_es_url
-    dataset_version = args.dataset_version
-    tag = args.tag
     qc_type = args.type
-    days_back = args.days_back
-    job_spec = "job-s1_%s_crawler:%s" % (qc_type, tag)
-
-    job_name = job_spec
-    job_name = job_name.lstrip('job-')
-
-    #Setup input arguments here
-    rule = {
-        "rule_name": job_name,
-        "queue": "factotum-job_worker-small",
-        "priority": 0,
-        "kwargs":'{}'
-    }
+    job_spec = "job-s1_%s_crawler:%s" % ("qc" if qc_type == "all" else qc_type, args.tag)
     params = [
-        {   
-            "name": "version_opt",
-            "from": "value",
-            "value": "--dataset_version",
-        },
-        {   
-            "name": "version",
-            "from": "value",
-            "value": dataset_version,
-        },
-        {   
-            "name": "tag_opt",
-            "from": "value",
-            "value": "--tag",
-        },
-        {   
-            "name": "tag",
-            "from": "value",
-            "value": tag,
-        },
-        {   
-            "name": "days_back_opt",
-            "from": "value",
-            "value": "--days_back",
-        },
-        {   
-            "name": "days_back",
-            "from": "value",
-            "value": days_back,
-        },
-        {
-            "name": "es_dataset_url",
-            "from": "value",
-            "value": ds_es_url,
-        }
+        ("version_opt", "--dataset_version"),
+        ("version", args.dataset_version),
+        ("tag_opt", "--tag"),
+        ("tag", args.tag),
+        ("days_back_opt", "--days_back"),
+        ("days_back", args.days_back),
+        ("es_dataset_url", args.ds_es_url),
     ]
     print("submitting %s crawler job" % qc_type)
-    submit_mozart_job({}, rule,
-        hysdsio={"id": "internal-temporary-wiring",
-                 "params": params,
-                 "job-specification": job_spec},
-        job_name=job_name, enable_dedup=False)
+    submit_crawler_job(job_spec, params)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""
+Helpers for materializing HySDS datasets.
+"""
+
+import os, glob, json, shutil, logging, traceback
+try: import fcntl
+except ImportError: fcntl = None
+
+from metrics import metrics
+
+
+# set logger
+logger = logging.getLogger('dataset_utils')
+logger.setLevel(logging.INFO)
+
+
+# per-file results of batch dataset creation in the job work dir
+RESULTS_FILE = "_create_results.json"
+
+# FICLONE ioctl from linux/fs.h
+FICLONE = 0x40049409
+
+# placement strategies in order of preference; each falls back to the
+# strategies after it
+PLACEMENTS = {
+    'move': ['move'],
+    'hardlink': ['hardlink', 'reflink', 'copy'],
+    'reflink': ['reflink', 'copy'],
+    'copy': ['copy'],
+}
+PLACEMENTS['auto'] = PLACEMENTS['hardlink']
+
+
+def reflink(src, dst):
+    """Clone src to dst sharing data blocks (btrfs, xfs, ...)."""
+
+    if fcntl is None: raise OSError("reflinks are not supported on this platform")
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    except (IOError, OSError):
+        if os.path.exists(dst): os.unlink(dst)
+        raise
+    shutil.copymode(src, dst)
+
+
+def place_file(src, dst_dir, placement="auto"):
+    """Place file into dataset dir. Return the strategy used.
+
+    "move" renames the file, falling back to copy and delete across
+    filesystems. "hardlink" and "reflink" leave src in place and fall back
+    to cheaper-to-expensive alternatives down to a full copy. "auto" is the
+    cheapest strategy that keeps src intact.
+    """
+
+    if placement not in PLACEMENTS:
+        raise RuntimeError("Unknown placement strategy: %s" % placement)
+    dst = os.path.join(dst_dir, os.path.basename(src))
+    if os.path.lexists(dst): os.unlink(dst)
+    for strategy in PLACEMENTS[placement]:
+        try:
+            if strategy == 'move': shutil.move(src, dst)
+            elif strategy == 'hardlink': os.link(src, dst)
+            elif strategy == 'reflink': reflink(src, dst)
+            else: shutil.copy(src, dst)
+        except (IOError, OSError) as e:
+            if strategy == PLACEMENTS[placement][-1]: raise
+            logger.info("Failed to %s %s: %s" % (strategy, src, str(e)))
+            continue
+        logger.info("placed %s in %s via %s" % (src, dst_dir, strategy))
+        return strategy
+
+
+def expand_inputs(inputs, accept):
+    """Return list of files named by inputs, each a file, a directory or a
+    glob. Files found in directories or by globs are kept only if
+    accept(path) is true; each file is returned once, in input order."""
+
+    files = []
+    for i in inputs:
+        if os.path.isdir(i):
+            found = [os.path.join(i, f) for f in sorted(os.listdir(i))]
+            found = [f for f in found if os.path.isfile(f) and accept(f)]
+        elif glob.has_magic(i): found = [f for f in sorted(glob.glob(i)) if accept(f)]
+        else: found = [i]
+        if len(found) == 0: logger.warning("No input files found for %s" % i)
+        files.extend(found)
+    unique, seen = [], set()
+    for f in files:
+        if f in seen: continue
+        seen.add(f)
+        unique.append(f)
+    return unique
+
+
+def get_dataset_id(path, version):
+    """Return dataset ID of product file for dataset version."""
+
+    return "%s-%s" % (os.path.splitext(os.path.basename(path))[0], version)
+
+
+def run_create(create, path):
+    """Run create(path) in a pool worker. Return its metrics."""
+
+    metrics.reset()
+    create(path)
+    return metrics.as_dict()
+
+
+def create_datasets(files, version, check, create, workers=1):
+    """Create datasets from files not already ingested. Return dict of
+    status ("created", "exists" or "failed: <error>") per file.
+
+    IDs of all files are deduped with a single check(list of IDs) call
+    returning the missing ones, then create(path) runs for each missing
+    file in a pool of workers processes (in this process if workers is 1).
+    A file that fails does not stop the others.
+    """
+
+    ids = dict([(f, get_dataset_id(f, version)) for f in files])
+    missing = check(list(ids.values()))
+    metrics.incr('found', len(ids) - len(missing))
+    metrics.incr('missing', len(missing))
+    logger.info("%d of %d datasets missing" % (len(missing), len(ids)))
+
+    results = {}
+    to_create = []
+    for f in files:
+        if ids[f] in missing: to_create.append(f)
+        else: results[f] = "exists"
+
+    def failed(f, e):
+        logger.error("Failed to create dataset from %s: %s\n%s" %
+                     (f, str(e), traceback.format_exc()))
+        results[f] = "failed: %s" % str(e)
+
+    if workers <= 1:
+        for f in to_create:
+            try:
+                create(f)
+                results[f] = "created"
+            except Exception as e: failed(f, e)
+    else:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = dict([(executor.submit(run_create, create, f), f) for f in to_create])
+            for future in as_completed(futures):
+                f = futures[future]
+                try:
+                    metrics.merge(future.result())
+                    results[f] = "created"
+                except Exception as e: failed(f, e)
+
+    counts = {}
+    for status in results.values():
+        status = status.split(':')[0]
+        counts[status] = counts.get(status, 0) + 1
+    logger.info("dataset creation summary: %s" % ", ".join(["%d %s" % (counts[k], k)
+                                                         for k in sorted(counts)]))
+    return results
+
+
+def write_results(results, results_file=RESULTS_FILE):
+    """Dump per-file results to results_file and raise if any failed."""
+
+    with open(results_file, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    failed = [f for f in sorted(results) if results[f].startswith("failed")]
+    if len(failed) > 0:
+        raise RuntimeError("Failed to create datasets for %d of %d files: %s" %
+                           (len(failed), len(results), ", ".join(failed)))
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""
+Verified, resumable file downloads for the Sentinel1 QC crawlers and
+dataset creators.
+"""
+
+import os, re, json, hashlib, logging, threading, requests
+
+from listing import get_session, map_ordered
+from metrics import metrics
+from qc_common import DownloadError, file_checksum, hash_file
+
+
+# set logger
+logger = logging.getLogger('download')
+logger.setLevel(logging.INFO)
+
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# bytes written between saves of the partial download state
+SAVE_INTERVAL = 16 << 20
+
+# smallest range fetched by each part of a parallel download
+MIN_PART_SIZE = 8 << 20
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-')
+
+
+class RangeError(DownloadError):
+    """Server did not honour a range request."""
+
+
+def get_validator(r):
+    """Return ETag or Last-Modified of response for If-Range, or None."""
+
+    return r.headers.get('ETag', r.headers.get('Last-Modified'))
+
+
+class PartialDownload(object):
+    """Partial file of a download and its sidecar state.
+
+    The state lists [start, end, bytes done] of each range of the file so
+    an interrupted download continues where it stopped. A single range
+    with an unknown end covers a sequential download.
+    """
+
+    def __init__(self, url, path):
+        self.url = url
+        self.tmp_file = "%s.part" % path
+        self.state_file = "%s.part.json" % path
+        self.lock = threading.Lock()
+        self.state = None
+        if os.path.exists(self.tmp_file) and os.path.exists(self.state_file):
+            try:
+                with open(self.state_file) as f:
+                    state = json.load(f)
+                if state.get('url') == url: self.state = state
+            except (IOError, ValueError) as e:
+                logger.warning("Ignoring state of %s: %s" % (self.tmp_file, str(e)))
+        if self.state is None: self.reset()
+
+    @property
+    def parts(self):
+        return self.state['parts']
+
+    @property
+    def done(self):
+        return sum([p[2] for p in self.parts])
+
+    def reset(self, length=None, validator=None, parts=1):
+        """Start over, splitting length bytes into parts ranges."""
+
+        if length is None or parts <= 1: ranges = [[0, length, 0]]
+        else:
+            size = -(-length // parts)
+            ranges = [[s, min(s + size, length), 0] for s in range(0, length, size)]
+        self.state = {'url': self.url, 'length': length, 'validator': validator,
+                      'parts': ranges}
+        with open(self.tmp_file, 'wb') as f:
+            if len(ranges) > 1: f.truncate(length)
+        self.save()
+
+    def save(self):
+        """Atomically write state."""
+
+        with self.lock:
+            tmp_file = "%s.tmp" % self.state_file
+            with open(tmp_file, 'w') as f:
+                json.dump(self.state, f)
+            os.replace(tmp_file, self.state_file)
+
+    def finish(self, path):
+        """Rename partial file to path and drop state."""
+
+        os.replace(self.tmp_file, path)
+        os.unlink(self.state_file)
+
+
+def fetch_part(session, partial, part, h=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Fetch the rest of a range of partial into its file, updating h."""
+
+    start, end, done = part
+    offset = start + done
+    headers = {}
+    ranged = offset > 0 or len(partial.parts) > 1
+    if ranged:
+        headers['Range'] = "bytes=%d-%s" % (offset, "" if end is None else end - 1)
+        if partial.state['validator']: headers['If-Range'] = partial.state['validator']
+    r = session.get(partial.url, headers=headers, stream=True, verify=False)
+    try:
+        if ranged:
+            if r.status_code == 416 or r.ok and r.status_code != 206:
+                raise RangeError("%s ignored range request (status %d)" %
+                                 (partial.url, r.status_code))
+            match = CONTENT_RANGE_RE.search(r.headers.get('Content-Range', ''))
+            if match is None or int(match.group(1)) != offset:
+                raise RangeError("%s returned unexpected range %s" %
+                                 (partial.url, r.headers.get('Content-Range')))
+        r.raise_for_status()
+        if partial.state['length'] is None and 'Content-Encoding' not in r.headers \
+           and 'Content-Length' in r.headers:
+            # Content-Length counts encoded bytes, so only record unencoded bodies
+            partial.state['length'] = part[1] = int(r.headers['Content-Length'])
+            partial.state['validator'] = get_validator(r)
+            partial.save()
+        with open(partial.tmp_file, 'r+b') as f:
+            f.seek(offset)
+            if len(partial.parts) == 1: f.truncate()
+            unsaved = 0
+            for chunk in r.iter_content(chunk_size):
+                f.write(chunk)
+                if h is not None: h.update(chunk)
+                part[2] += len(chunk)
+                unsaved += len(chunk)
+                if unsaved >= SAVE_INTERVAL:
+                    f.flush()
+                    partial.save()
+                    unsaved = 0
+    finally:
+        r.close()
+        partial.save()
+    if part[1] is not None and part[0] + part[2] != part[1]:
+        raise DownloadError("Downloaded %d of %d bytes from %s." %
+                            (part[0] + part[2], part[1], partial.url))
+
+
+def fetch(session, partial, workers=1, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Fetch the rest of partial. Return tuple of (size, sha256 hex digest)."""
+
+    if len(partial.parts) > 1:
+        pending = [p for p in partial.parts if p[0] + p[2] < p[1]]
+        map_ordered(lambda p: fetch_part(session, partial, p, None, chunk_size),
+                    pending, workers)
+        return file_checksum(partial.tmp_file, chunk_size)
+
+    # hash what an earlier attempt left and the rest as it arrives
+    part = partial.parts[0]
+    h = hashlib.sha256()
+    if part[2] > 0: hash_file(h, partial.tmp_file, part[2], chunk_size)
+    fetch_part(session, partial, part, h, chunk_size)
+    return part[2], h.hexdigest()
+
+
+def download(url, path, session=None, parts=1, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Download url to path. Return tuple of (size, sha256 hex digest).
+
+    Data goes to path.part, with progress kept in path.part.json, and is
+    renamed to path only once complete. A single attempt is made; retry
+    through MirrorSet.with_failover(). The next attempt resumes from the
+    partial file with a range request, or starts over if the server does
+    not honour ranges. With parts greater than 1, files of at least
+    2 * MIN_PART_SIZE bytes are fetched as up to parts concurrent ranges.
+    """
+
+    if session is None: session = get_session(parts)
+    partial = PartialDownload(url, path)
+    if partial.state['length'] is None: partial.reset()
+    resumed = partial.done
+    if resumed > 0:
+        logger.info("resuming %s at %d bytes" % (url, resumed))
+        metrics.incr('downloads_resumed')
+    elif parts > 1:
+        try:
+            r = session.head(url, allow_redirects=True, verify=False)
+            length = int(r.headers.get('Content-Length', 0))
+            if r.ok and r.headers.get('Accept-Ranges') == 'bytes' \
+               and 'Content-Encoding' not in r.headers and length >= 2 * MIN_PART_SIZE:
+                partial.reset(length, get_validator(r), min(parts, length // MIN_PART_SIZE))
+        except requests.exceptions.RequestException as e:
+            logger.warning("Failed to get size of %s: %s" % (url, str(e)))
+
+    with metrics.timer('download'):
+        try:
+            try: size, sha256 = fetch(session, partial, parts, chunk_size)
+            except RangeError as e:
+                logger.warning("%s. Restarting download." % str(e))
+                resumed = 0
+                partial.reset()
+                size, sha256 = fetch(session, partial, parts, chunk_size)
+        finally: metrics.incr('bytes_downloaded', partial.done - resumed)
+        partial.finish(path)
+    logger.info("downloaded %s (%d bytes, sha256 %s)" % (url, size, sha256))
+    return size, sha256
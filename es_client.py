@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Shared ElasticSearch client for the Sentinel1 QC crawlers and dataset creators.
+"""
+
+import os, json, logging, threading, requests, backoff
+
+from metrics import metrics
+
+
+# set logger
+logger = logging.getLogger('es_client')
+logger.setLevel(logging.INFO)
+
+
+# size of the keep-alive connection pool to ES
+ES_POOL_SIZE = int(os.environ.get('S1_QC_ES_POOL_SIZE', 10))
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session(pool_size=None):
+    """Return the shared ES session, creating it on first use."""
+
+    global _session
+    with _session_lock:
+        if _session is None:
+            if pool_size is None: pool_size = ES_POOL_SIZE
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                    pool_maxsize=pool_size,
+                                                    pool_block=True)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def get_search_url(es_url, es_index):
+    """Return _search URL for index."""
+
+    return '%s/%s/_search' % (es_url.rstrip('/'), es_index)
+
+
+@backoff.on_exception(backoff.expo, requests.exceptions.RequestException,
+                      max_tries=8, max_value=32)
+def search(es_url, es_index, query):
+    """Run query against index. Return response.
+
+    Connection errors and server errors are retried with exponential
+    backoff; other responses are returned for the caller to handle.
+    """
+
+    search_url = get_search_url(es_url, es_index)
+    with metrics.timer('es_check'):
+        r = get_session().post(search_url, data=json.dumps(query))
+    metrics.incr('es_queries')
+    if r.status_code >= 500:
+        logger.error("Failed to query %s:\n%s" % (es_url, r.text))
+        r.raise_for_status()
+    return r
+
+
+def log_failure(es_url, query, r):
+    """Log failed query."""
+
+    logger.error("Failed to query %s:\n%s" % (es_url, r.text))
+    logger.error("query: %s" % json.dumps(query, indent=2))
+    logger.error("returned: %s" % r.text)
+
+
+def find_ids(es_url, es_index, ids, chunk_size=500):
+    """Query for documents with specified IDs in chunks using terms queries
+    on _id. Return set of missing IDs."""
+
+    ids = list(ids)
+    found = set()
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i+chunk_size]
+        query = {
+            "query":{"bool":{"must":[{"terms":{"_id":chunk}}]}},
+            "fields": [],
+            "size": len(chunk),
+        }
+        r = search(es_url, es_index, query)
+        if r.status_code == 200:
+            found.update([hit['_id'] for hit in r.json()['hits']['hits']])
+        else:
+            log_failure(es_url, query, r)
+            if r.status_code != 404: r.raise_for_status()
+    return set(ids) - found
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Local catalog of dataset IDs confirmed ingested, consulted before ES.
+"""
+
+import os, time, math, sqlite3, hashlib, logging, threading
+
+from crawl_state import STATE_DIR
+from metrics import metrics
+
+
+# set logger
+logger = logging.getLogger('id_catalog')
+logger.setLevel(logging.INFO)
+
+
+CATALOG_FILE = os.path.join(STATE_DIR, 'id_catalog.sqlite')
+
+# days after which a cataloged ID is checked against ES again
+CATALOG_TTL = float(os.environ.get('S1_QC_CATALOG_TTL', 7))
+
+# IDs per SQLite query; stays under the default limit of 999 variables
+QUERY_CHUNK_SIZE = 500
+
+
+class BloomFilter(object):
+    """Set membership with no false negatives and about error_rate false
+    positives once capacity keys are added."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for p in self.positions(key): self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key):
+        return all([self.bits[p >> 3] & (1 << (p & 7)) for p in self.positions(key)])
+
+
+class IdCatalog(object):
+    """Dataset IDs confirmed present in ES per dataset version, backed by
+    SQLite.
+
+    An ID confirmed more than ttl days ago is treated as unknown so it is
+    revalidated against ES. A bloom filter of the catalog per dataset
+    version answers most lookups of IDs not in the catalog without a query.
+    """
+
+    def __init__(self, catalog_file=CATALOG_FILE, ttl=CATALOG_TTL):
+        self.catalog_file = os.path.abspath(catalog_file)
+        self.ttl = ttl * 86400.
+        catalog_dir = os.path.dirname(self.catalog_file)
+        if not os.path.isdir(catalog_dir): os.makedirs(catalog_dir, 0o755)
+        self.lock = threading.Lock()
+        self.blooms = {}
+        self.conn = sqlite3.connect(self.catalog_file, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS ids (version TEXT, id TEXT, " +
+                              "confirmed REAL, PRIMARY KEY (version, id)) WITHOUT ROWID")
+            expired = self.conn.execute("DELETE FROM ids WHERE confirmed < ?",
+                                        (time.time() - self.ttl,)).rowcount
+        logger.info("opened ID catalog %s, expired %d IDs" % (self.catalog_file, expired))
+
+    def get_bloom(self, version):
+        """Return bloom filter of IDs cataloged for version."""
+
+        if version not in self.blooms:
+            ids = [r[0] for r in self.conn.execute("SELECT id FROM ids WHERE version = ?",
+                                                   (version,))]
+            bloom = BloomFilter(max(10000, 2 * len(ids)))
+            for id in ids: bloom.add(id)
+            self.blooms[version] = bloom
+        return self.blooms[version]
+
+    def known(self, version, ids):
+        """Return set of ids confirmed present within the TTL."""
+
+        found = set()
+        with self.lock:
+            bloom = self.get_bloom(version)
+            candidates = [id for id in ids if id in bloom]
+            cutoff = time.time() - self.ttl
+            for i in range(0, len(candidates), QUERY_CHUNK_SIZE):
+                chunk = candidates[i:i+QUERY_CHUNK_SIZE]
+                rows = self.conn.execute("SELECT id FROM ids WHERE version = ? AND " +
+                                         "confirmed >= ? AND id IN (%s)" %
+                                         ",".join(["?"] * len(chunk)),
+                                         [version, cutoff] + chunk)
+                found.update([r[0] for r in rows])
+        metrics.incr('catalog_hits', len(found))
+        return found
+
+    def add(self, version, ids):
+        """Record ids as confirmed present now."""
+
+        now = time.time()
+        with self.lock:
+            bloom = self.get_bloom(version)
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO ids VALUES (?, ?, ?)",
+                                      [(version, id, now) for id in ids])
+            for id in ids: bloom.add(id)
+
+    def find_missing(self, version, ids, check):
+        """Return set of ids missing from ES, calling check(list of ids) for
+        a set of missing IDs only on ids not in the catalog."""
+
+        known = self.known(version, ids)
+        unknown = [id for id in ids if id not in known]
+        missing = check(unknown) if len(unknown) > 0 else set()
+        self.add(version, [id for id in unknown if id not in missing])
+        return missing
+
+    def close(self):
+        self.conn.close()
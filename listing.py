@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""
+Directory listing fetches for the Sentinel1 QC crawlers.
+"""
+
+import os, re, json, hashlib, logging, threading, requests
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from crawl_state import STATE_DIR, atomic_write
+from metrics import metrics
+
+
+# set logger
+logger = logging.getLogger('listing')
+logger.setLevel(logging.INFO)
+
+
+LISTING_CACHE_DIR = os.path.join(STATE_DIR, 'listing_cache')
+
+HREF_RE = re.compile(br'href\s*=\s*["\']([^"\']*)["\']', re.I)
+
+# longest partial href carried over between chunks
+MAX_HREF_LEN = 4096
+
+
+def get_session(pool_size=10):
+    """Return session whose connection pool can serve pool_size threads."""
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class HostLimiter(object):
+    """Cap the number of concurrent requests made to each host."""
+
+    def __init__(self, max_per_host=4):
+        self.max_per_host = max_per_host
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def get(self, url):
+        """Return semaphore for host of url."""
+
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self.semaphores[host]
+
+
+def map_ordered(func, items, workers=1):
+    """Apply func to items using up to workers threads. Return list of
+    results in the order of items."""
+
+    items = list(items)
+    if workers <= 1 or len(items) <= 1: return [func(i) for i in items]
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
+def iter_listing_links(r, href_re, chunk_size=65536):
+    """Yield (filename, href) for each link in streamed listing response
+    whose href matches href_re.
+
+    The body is scanned chunk by chunk so memory use is bounded by the
+    chunk size regardless of the listing size.
+    """
+
+    buf = b''
+    for chunk in r.iter_content(chunk_size):
+        buf += chunk
+        end = 0
+        for m in HREF_RE.finditer(buf):
+            end = m.end()
+            href = m.group(1).decode('utf-8')
+            if href_re.search(href):
+                yield os.path.basename(href), href
+        buf = buf[max(end, len(buf) - MAX_HREF_LEN):]
+
+
+class ListingCache(object):
+    """On-disk cache of parsed listings keyed by URL.
+
+    Each entry records the ETag and Last-Modified validators of the last
+    200 response along with the parsed result and the name of the parser
+    that produced it.
+    """
+
+    def __init__(self, cache_dir=LISTING_CACHE_DIR):
+        self.cache_dir = os.path.abspath(cache_dir)
+
+    def cache_file(self, url):
+        """Return path of cache file for url."""
+
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, "%s.json" % key)
+
+    def load(self, url):
+        """Return cached entry for url or None."""
+
+        cache_file = self.cache_file(url)
+        if not os.path.exists(cache_file): return None
+        try:
+            with open(cache_file) as f:
+                entry = json.load(f)
+        except ValueError:
+            logger.warning("Ignoring corrupt listing cache file %s" % cache_file)
+            return None
+        return entry if entry.get('url') == url else None
+
+    def save(self, url, entry):
+        """Atomically write cached entry for url."""
+
+        entry = dict(entry, url=url)
+        def write(tmp_file):
+            with open(tmp_file, 'w') as f:
+                json.dump(entry, f)
+        atomic_write(self.cache_file(url), write)
+
+
+def fetch_listing(session, url, parse, cache=None, limiter=None):
+    """Fetch and parse listing at url. Return tuple of (response, parsed result).
+
+    The parse callable receives the streamed response and must return a JSON
+    serializable result. With a cache, the request is made conditional on
+    the stored validators and a 304 reuses the stored result without
+    parsing. The parsed result is None if the listing is not available.
+    With a limiter, the fetch counts against the per-host concurrency cap.
+    A single request is made; retry through MirrorSet.call().
+    """
+
+    if limiter is not None:
+        with limiter.get(url):
+            return fetch_listing(session, url, parse, cache)
+
+    entry = cache.load(url) if cache is not None else None
+    if entry is not None and entry.get('parser') != parse.__name__: entry = None
+    headers = {}
+    if entry is not None:
+        if entry.get('etag'): headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'): headers['If-Modified-Since'] = entry['last_modified']
+    with metrics.timer('listing_fetch'):
+        r = session.get(url, headers=headers, stream=True, verify=False)
+    metrics.incr('listings_fetched')
+    if r.status_code == 304 and entry is not None:
+        logger.info("Listing unchanged at %s. Using cached result." % url)
+        metrics.incr('listings_unchanged')
+        r.close()
+        return r, entry['result']
+    # release the pooled connection of streamed responses that are not read
+    if r.status_code != 200:
+        r.close()
+        return r, None
+    # parse time includes reading the streamed body
+    with metrics.timer('listing_parse'):
+        result = parse(r)
+    if cache is not None and (r.headers.get('ETag') or r.headers.get('Last-Modified')):
+        cache.save(url, {
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+            'parser': parse.__name__,
+            'result': result,
+        })
+    return r, result
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+Snapshots of the IDs in each listing, diffed between crawls to find
+added and removed files.
+"""
+
+import os, json, gzip, hashlib, logging
+from datetime import datetime
+
+from crawl_state import STATE_DIR, atomic_write
+from metrics import metrics
+
+
+# set logger
+logger = logging.getLogger('listing_snapshot')
+logger.setLevel(logging.INFO)
+
+
+SNAPSHOT_DIR = os.path.join(STATE_DIR, 'snapshots')
+
+# JSON lines of added and removed IDs, appended to in the snapshot directory
+EVENTS_FILE = 'listing_events.jsonl'
+
+
+def diff_sorted(old, new):
+    """Return tuple of (added, removed) lists of IDs between sorted lists
+    of IDs old and new, in a single merge pass."""
+
+    added, removed = [], []
+    i = j = 0
+    while i < len(old) and j < len(new):
+        if old[i] == new[j]:
+            i += 1
+            j += 1
+        elif old[i] < new[j]:
+            removed.append(old[i])
+            i += 1
+        else:
+            added.append(new[j])
+            j += 1
+    removed.extend(old[i:])
+    added.extend(new[j:])
+    return added, removed
+
+
+class ListingSnapshots(object):
+    """Sorted IDs of each listing as of the last successful crawl, kept as
+    gzipped newline-delimited files keyed by listing.
+
+    New snapshots are staged by diff() and only written by save(), so a
+    crawl that fails before its additions are ingested sees them again.
+    """
+
+    def __init__(self, snapshot_dir=SNAPSHOT_DIR):
+        self.snapshot_dir = os.path.abspath(snapshot_dir)
+        self.snapshots = {}
+        self.pending = {}
+        self.events = []
+
+    def snapshot_file(self, key):
+        """Return path of snapshot file for key."""
+
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.snapshot_dir, "%s.txt.gz" % digest)
+
+    def load(self, key):
+        """Return sorted list of IDs in last snapshot of key, or None if
+        there is none."""
+
+        if key not in self.snapshots:
+            snapshot_file = self.snapshot_file(key)
+            ids = None
+            if os.path.exists(snapshot_file):
+                try:
+                    with gzip.open(snapshot_file, 'rt') as f:
+                        lines = f.read().split('\n')
+                    # first line names the listing, guarding against hash collisions
+                    if lines[0] == key: ids = [id for id in lines[1:] if id != '']
+                except (IOError, EOFError) as e:
+                    logger.warning("Ignoring corrupt snapshot file %s: %s" %
+                                   (snapshot_file, str(e)))
+            self.snapshots[key] = ids
+        return self.snapshots[key]
+
+    def known(self, key):
+        """Return set of IDs in last snapshot of key, or None if there is none."""
+
+        ids = self.load(key)
+        return None if ids is None else set(ids)
+
+    def diff(self, key, ids):
+        """Stage ids as the new snapshot of key. Return tuple of (added,
+        removed) lists of IDs since the last snapshot, or None if there is
+        none."""
+
+        new = sorted(set(ids))
+        old = self.load(key)
+        self.pending[key] = new
+        if old is None:
+            logger.info("no snapshot of %s, recording %d IDs" % (key, len(new)))
+            return None
+        added, removed = diff_sorted(old, new)
+        now = datetime.utcnow().isoformat() + 'Z'
+        for event, changed in (('added', added), ('removed', removed)):
+            metrics.incr('listing_%s' % event, len(changed))
+            self.events.extend([{'time': now, 'listing': key, 'event': event, 'id': id}
+                                for id in changed])
+        for id in removed: logger.warning("%s removed from %s" % (id, key))
+        logger.info("%s: %d added, %d removed, %d unchanged" %
+                    (key, len(added), len(removed), len(new) - len(added)))
+        return added, removed
+
+    @property
+    def removed(self):
+        """Return list of IDs removed from staged listings."""
+
+        return [e['id'] for e in self.events if e['event'] == 'removed']
+
+    def save(self):
+        """Atomically write staged snapshots and append their events."""
+
+        os.makedirs(self.snapshot_dir, 0o755, exist_ok=True)
+        for key, ids in self.pending.items():
+            def write(tmp_file):
+                with gzip.open(tmp_file, 'wt') as f:
+                    f.write('\n'.join([key] + ids) + '\n')
+            atomic_write(self.snapshot_file(key), write)
+            self.snapshots[key] = ids
+        if len(self.events) > 0:
+            with open(os.path.join(self.snapshot_dir, EVENTS_FILE), 'a') as f:
+                for event in self.events: f.write("%s\n" % json.dumps(event, sort_keys=True))
+        logger.info("saved %d listing snapshots to %s" % (len(self.pending), self.snapshot_dir))
+        self.pending = {}
+        self.events = []
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Per-stage timings and counters for the Sentinel1 QC crawlers and dataset creators.
+"""
+
+import json, time, threading
+from contextlib import contextmanager
+
+
+METRICS_FILE = "_metrics.json"
+
+
+class Metrics(object):
+    """Thread-safe accumulator of stage timers and counters."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Drop all timers and counters."""
+
+        with self.lock:
+            self.start = time.time()
+            self.timers = {}
+            self.counters = {}
+
+    @contextmanager
+    def timer(self, stage):
+        """Time the enclosed block and add it to stage."""
+
+        t0 = time.time()
+        try: yield
+        finally: self.add_time(stage, time.time() - t0)
+
+    def add_time(self, stage, seconds):
+        """Add seconds spent in stage."""
+
+        with self.lock:
+            timer = self.timers.setdefault(stage, {"count": 0, "seconds": 0.})
+            timer['count'] += 1
+            timer['seconds'] += seconds
+
+    def incr(self, counter, value=1):
+        """Increment counter by value."""
+
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def merge(self, other):
+        """Add timers and counters of other, a dict from as_dict() (e.g. of a
+        worker process)."""
+
+        with self.lock:
+            for stage, t in other['timers'].items():
+                timer = self.timers.setdefault(stage, {"count": 0, "seconds": 0.})
+                timer['count'] += t['count']
+                timer['seconds'] += t['seconds']
+            for counter, value in other['counters'].items():
+                self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def as_dict(self):
+        """Return metrics as a JSON serializable dict."""
+
+        with self.lock:
+            return {
+                "wall_seconds": time.time() - self.start,
+                "timers": dict((k, dict(v)) for k, v in self.timers.items()),
+                "counters": dict(self.counters),
+            }
+
+    def write(self, metrics_file=METRICS_FILE):
+        """Dump metrics JSON to metrics_file (in the job work dir by default)."""
+
+        with open(metrics_file, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+
+
+# shared instance used by all modules of a process
+metrics = Metrics()
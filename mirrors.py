@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""
+Mirror selection and failover for the Sentinel1 QC listing and data servers.
+"""
+
+import os, json, time, logging, threading, requests, backoff
+
+from crawl_state import STATE_DIR
+from qc_common import DownloadError
+
+
+# set logger
+logger = logging.getLogger('mirrors')
+logger.setLevel(logging.INFO)
+
+
+# JSON file of {product type: {"listing": [base URLs], "data": [base URLs]}};
+# mirrors of a role must share the same path layout
+MIRRORS_FILE = os.environ.get('S1_QC_MIRRORS_FILE', os.path.join(STATE_DIR, 'mirrors.json'))
+
+# seconds to wait for a mirror to answer a probe
+PROBE_TIMEOUT = 10
+
+# rounds of attempts over all mirrors before a call fails
+MAX_TRIES = 8
+
+
+def load_mirrors(mirrors_file=MIRRORS_FILE):
+    """Return mirror config from mirrors_file, or an empty one if it does not exist."""
+
+    if mirrors_file is None or not os.path.exists(mirrors_file): return {}
+    with open(mirrors_file) as f:
+        mirrors = json.load(f)
+    logger.info("loaded mirrors from %s" % mirrors_file)
+    return mirrors
+
+
+def is_mirror_error(e):
+    """Return True if e is worth failing over to another mirror for: a
+    connection error or timeout, a 5xx response or a truncated download.
+    Client errors such as a 404 and local disk errors are not."""
+
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                      requests.exceptions.ChunkedEncodingError, DownloadError)):
+        return True
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is not None and e.response.status_code >= 500
+    return False
+
+
+class MirrorSet(object):
+    """Base URLs serving the same paths, ranked by health and latency.
+
+    A mirror that fails a call drops to the end of the ranking so later
+    calls in the same run go to the next one. The ranking is shared by
+    the threads of a crawl.
+    """
+
+    def __init__(self, urls):
+        self.urls = list(urls)
+        self.lock = threading.Lock()
+        if len(self.urls) == 0: raise RuntimeError("No mirrors configured.")
+
+    def probe(self, session, timeout=PROBE_TIMEOUT):
+        """Rank healthy mirrors by latency of a HEAD request, ahead of
+        unhealthy ones."""
+
+        latencies = {}
+        for url in self.ranking():
+            t0 = time.time()
+            try:
+                r = session.head(url, timeout=timeout, verify=False)
+                if r.status_code < 500: latencies[url] = time.time() - t0
+                else: logger.warning("Mirror %s unhealthy: status %d" % (url, r.status_code))
+            except requests.exceptions.RequestException as e:
+                logger.warning("Mirror %s unhealthy: %s" % (url, str(e)))
+        with self.lock:
+            self.urls.sort(key=lambda url: (url not in latencies, latencies.get(url, 0)))
+        logger.info("ranked mirrors: %s" % ", ".join(["%s (%s)" % (url, "%.3fs" % latencies[url]
+                                                      if url in latencies else "down")
+                                                      for url in self.ranking()]))
+
+    def ranking(self):
+        """Return list of base URLs, best first."""
+
+        with self.lock: return list(self.urls)
+
+    @property
+    def current(self):
+        """Return base URL of best mirror."""
+
+        with self.lock: return self.urls[0]
+
+    def demote(self, url):
+        with self.lock:
+            if url in self.urls and len(self.urls) > 1:
+                self.urls.remove(url)
+                self.urls.append(url)
+
+    def call(self, func, max_tries=MAX_TRIES):
+        """Return func(base URL) of the first mirror it succeeds on.
+
+        func should make a single attempt: each mirror is tried once per
+        round, for up to max_tries rounds with exponential backoff between
+        them, so a dead mirror is failed over immediately. Errors that are
+        not mirror errors (see is_mirror_error()) are raised at once.
+        """
+
+        @backoff.on_exception(backoff.expo, IOError, max_tries=max_tries, max_value=32,
+                              giveup=lambda e: not is_mirror_error(e))
+        def try_mirrors():
+            for url in self.ranking():
+                try: return func(url)
+                except IOError as e:
+                    if not is_mirror_error(e): raise
+                    logger.warning("Mirror %s failed: %s" % (url, str(e)))
+                    self.demote(url)
+                    error = e
+            raise error
+        return try_mirrors()
+
+    def with_failover(self, url, func):
+        """Return func(url), retrying with url moved to other mirrors if it
+        fails. url not under a mirror is only retried as is."""
+
+        base = [m for m in self.ranking() if url.startswith(m)]
+        if len(base) == 0: return MirrorSet([url]).call(func)
+        path = url[len(base[0]):]
+        return self.call(lambda m: func(m + path))
+
+
+def get_mirrors(config, product, role, default, session=None):
+    """Return MirrorSet for role ("listing" or "data") of product from
+    config, or of default. Multiple mirrors are probed with session."""
+
+    mirrors = MirrorSet(config.get(product, {}).get(role) or [default])
+    if session is not None and len(mirrors.urls) > 1: mirrors.probe(session)
+    return mirrors
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""
+Find the best Sentinel1 orbit covering time ranges using an in-memory
+index of orbit validity windows.
+"""
+
+import logging, argparse
+from bisect import bisect_left, bisect_right
+
+import es_client
+from metrics import metrics
+from qc_filenames import parse_orbit_name, parse_query_time, to_datetime
+
+
+# set logger
+log_format = "[%(asctime)s: %(levelname)s/%(funcName)s] %(message)s"
+logging.basicConfig(format=log_format, level=logging.INFO)
+
+class LogFilter(logging.Filter):
+    def filter(self, record):
+        if not hasattr(record, 'id'): record.id = '--'
+        return True
+
+logger = logging.getLogger('orbit_index')
+logger.setLevel(logging.INFO)
+logger.addFilter(LogFilter())
+
+
+# orbit types in order of precedence
+ORBIT_TYPES = ['POEORB', 'RESORB']
+
+# seconds an orbit must extend past each end of the queried range
+MARGIN = 60
+
+
+class OrbitIndex(object):
+    """Validity windows of orbits sorted by start time per (sat, orbit type).
+
+    A window covering [start, end] must begin before start, and no window
+    is longer than the longest one indexed, so only the windows starting in
+    [start - longest window, start] are examined by a query.
+    """
+
+    def __init__(self, names=()):
+        self.windows = {}
+        self.starts = {}
+        self.longest = {}
+        for name in names: self.add(name)
+        self.build()
+
+    def add(self, name):
+        """Add orbit by filename or dataset ID. Call build() before querying."""
+
+        info = parse_orbit_name(name)
+        if info is None:
+            raise RuntimeError("Failed to parse orbit: %s" % name)
+        self.windows.setdefault((info.sat, info.type), []).append((info.start, info.stop,
+                                                                   info.creation, name))
+
+    def build(self):
+        """Sort windows for querying."""
+
+        for key, windows in self.windows.items():
+            windows.sort()
+            self.starts[key] = [w[0] for w in windows]
+            self.longest[key] = max([w[1] - w[0] for w in windows])
+
+    def __len__(self):
+        return sum([len(w) for w in self.windows.values()])
+
+    def covering(self, sat, orbit_type, start, end, margin=MARGIN):
+        """Return list of (start, stop, creation, name) of windows covering
+        [start - margin, end + margin]."""
+
+        key = (sat, orbit_type)
+        if key not in self.windows: return []
+        starts = self.starts[key]
+        lo = bisect_left(starts, start - margin - self.longest[key])
+        hi = bisect_right(starts, start - margin)
+        return [w for w in self.windows[key][lo:hi] if w[1] >= end + margin]
+
+    def best(self, sat, start, end, margin=MARGIN):
+        """Return name of the best orbit covering [start, end] or None.
+
+        POEORBs take precedence over RESORBs and newer productions over
+        older ones of the same type.
+        """
+
+        for orbit_type in ORBIT_TYPES:
+            windows = self.covering(sat, orbit_type, start, end, margin)
+            if len(windows) > 0:
+                return max(windows, key=lambda w: w[2])[3]
+        return None
+
+
+def prune_superseded(candidates, listed=(), ingested=()):
+    """Drop superseded RESORBs from candidates. Return tuple of (kept
+    candidates, dict of skipped counts).
+
+    Candidates are (id, url) tuples. A RESORB is skipped if its validity
+    window is fully covered by a POEORB or by a newer RESORB of the same
+    satellite among the candidates and the listed or ingested orbit IDs.
+    """
+
+    index = OrbitIndex(list(listed) + list(ingested) + [id for id, url in candidates])
+    kept = []
+    skipped = {'covered_by_poeorb': 0, 'superseded_resorb': 0}
+    for id, url in candidates:
+        info = parse_orbit_name(id)
+        if info.type == 'RESORB':
+            if len(index.covering(info.sat, 'POEORB', info.start, info.stop, 0)) > 0:
+                skipped['covered_by_poeorb'] += 1
+                continue
+            newer = [w for w in index.covering(info.sat, 'RESORB', info.start, info.stop, 0)
+                     if w[2] > info.creation]
+            if len(newer) > 0:
+                skipped['superseded_resorb'] += 1
+                continue
+        kept.append((id, url))
+    for reason, count in skipped.items():
+        metrics.incr('skipped_%s' % reason, count)
+    logger.info("skipped %d RESORBs covered by POEORBs and %d superseded by newer RESORBs" %
+                (skipped['covered_by_poeorb'], skipped['superseded_resorb']))
+    return kept, skipped
+
+
+def get_ingested_orbits(es_url, dataset_version, orbit_types=ORBIT_TYPES, since=None,
+                        page_size=10000):
+    """Return list of ingested orbit dataset IDs, optionally only those
+    whose validity ends at or after since (epoch seconds)."""
+
+    if since is None: match = {"match_all": {}}
+    else: match = {"range": {"endtime": {"gte": to_datetime(since).isoformat('T')}}}
+    ids = []
+    for orbit_type in orbit_types:
+        es_index = "grq_%s_s1-aux_%s" % (dataset_version, orbit_type.lower())
+        offset = 0
+        while True:
+            query = {
+                "query": match,
+                "fields": [],
+                "from": offset,
+                "size": page_size,
+            }
+            r = es_client.search(es_url, es_index, query)
+            if r.status_code != 200:
+                es_client.log_failure(es_url, query, r)
+                if r.status_code == 404: break
+                r.raise_for_status()
+            hits = r.json()['hits']['hits']
+            ids.extend([hit['_id'] for hit in hits])
+            if len(hits) < page_size: break
+            offset += page_size
+    return ids
+
+
+def get_listed_orbits(dataset_version):
+    """Return list of orbit IDs in the full QC server listings."""
+
+    from crawl_orbits import crawl_orbits
+    return [id for id, url in crawl_orbits(dataset_version, 0, full_resync=True, quiet=True)]
+
+
+def query_file(index, queries_file, margin=MARGIN):
+    """Yield tuple of (query line, best orbit) for each query in file.
+
+    Each line holds a satellite and the start and end times of a range,
+    e.g. "S1A 2017-05-25T00:00:00 2017-05-25T00:00:25".
+    """
+
+    with open(queries_file) as f:
+        for line in f:
+            line = line.strip()
+            if line == '' or line.startswith('#'): continue
+            sat, start, end = line.split()
+            yield line, index.best(sat, parse_query_time(start), parse_query_time(end), margin)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("queries_file", help="file of \"<sat> <start> <end>\" lines")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--names", help="file of orbit filenames or IDs to index, one per line")
+    source.add_argument("--ds_es_url", help="index orbits ingested in this ElasticSearch")
+    source.add_argument("--crawl", help="index orbits in the QC server listings",
+                        action="store_true", default=False)
+    parser.add_argument("--dataset_version", help="dataset version",
+                        default="v1.1", required=False)
+    parser.add_argument("--margin", help="seconds orbits must extend past each end of a range",
+                        type=int, default=MARGIN, required=False)
+    args = parser.parse_args()
+
+    if args.names:
+        with open(args.names) as f:
+            names = [l.strip() for l in f if l.strip() != '']
+    elif args.ds_es_url: names = get_ingested_orbits(args.ds_es_url, args.dataset_version)
+    else: names = get_listed_orbits(args.dataset_version)
+    index = OrbitIndex(names)
+    logger.info("indexed %d orbits" % len(index))
+    for line, orbit in query_file(index, args.queries_file, args.margin):
+        print("%s\t%s" % (line, orbit if orbit is not None else "NONE"))
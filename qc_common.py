@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Lightweight helpers shared by the Sentinel1 QC crawlers and dataset
+creators. Only the standard library is imported at load time so the job
+entry points start fast.
+"""
+
+import hashlib
+
+
+# listing and data server of precise and restituted orbits
+ORBIT_SERVER = 'https://s1qc.asf.alaska.edu/'
+
+HASH_CHUNK_SIZE = 1 << 20
+
+
+class DownloadError(IOError):
+    """Download ended before the expected number of bytes arrived."""
+
+
+def hash_file(h, path, length=None, chunk_size=HASH_CHUNK_SIZE):
+    """Update h with file, or its first length bytes. Return bytes read."""
+
+    size = 0
+    with open(path, 'rb') as f:
+        while length is None or size < length:
+            chunk = f.read(chunk_size if length is None else min(chunk_size, length - size))
+            if chunk == b'': break
+            h.update(chunk)
+            size += len(chunk)
+    return size
+
+
+def file_checksum(path, chunk_size=HASH_CHUNK_SIZE):
+    """Return tuple of (size, sha256 hex digest) of file."""
+
+    h = hashlib.sha256()
+    size = hash_file(h, path, None, chunk_size)
+    return size, h.hexdigest()
+
+
+def submit_mozart_job(*args, **kwargs):
+    """Submit job to Mozart with hysds_commons.job_utils.submit_mozart_job.
+
+    The HySDS client loads Celery config on import, so it is only imported
+    by jobs that submit.
+    """
+
+    from hysds.celery import app
+    from hysds_commons.job_utils import submit_mozart_job
+    return submit_mozart_job(*args, **kwargs)
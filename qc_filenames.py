@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Parse Sentinel1 orbit and calibration filenames into compact records.
+"""
+
+import re, calendar
+from collections import namedtuple
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+
+# filenames or dataset IDs, with or without extension and version suffix, e.g.
+#   S1B_OPER_AUX_POEORB_OPOD_20170614T111434_V20170524T225942_20170526T005942.EOF
+#   S1A_AUX_CAL_V20160627T000000_G20170522T132042-v1.1
+# only AUX_CAL calibration files are ingested; other AUX types (AUX_INS,
+# AUX_PP1, ...) listed alongside them do not match
+ORBIT_NAME_RE = re.compile(r'(?P<sat>S1\w)_OPER_AUX_(?P<type>\w+?)_OPOD_(?P<cr>\d{8}T\d{6})_V(?P<vs>\d{8}T\d{6})_(?P<ve>\d{8}T\d{6})')
+CAL_NAME_RE = re.compile(r'(?P<sat>S1\w)_AUX_(?P<type>CAL)_V(?P<vs>\d{8}T\d{6})_G(?P<cr>\d{8}T\d{6})')
+
+TIME_FMT = "%Y%m%dT%H%M%S"
+EPOCH = datetime(1970, 1, 1)
+
+# times are UTC epoch seconds
+OrbitName = namedtuple('OrbitName', ['sat', 'type', 'creation', 'start', 'stop'])
+CalName = namedtuple('CalName', ['sat', 'type', 'start', 'creation'])
+
+
+def parse_time(s):
+    """Convert YYYYMMDDTHHMMSS to epoch seconds."""
+
+    return calendar.timegm((int(s[0:4]), int(s[4:6]), int(s[6:8]),
+                            int(s[9:11]), int(s[11:13]), int(s[13:15])))
+
+
+def format_time(t):
+    """Convert epoch seconds to YYYYMMDDTHHMMSS."""
+
+    return to_datetime(t).strftime(TIME_FMT)
+
+
+def parse_query_time(s):
+    """Return epoch seconds of ISO 8601 date or time, or YYYYMMDDTHHMMSS,
+    string."""
+
+    s = s.rstrip('Z')
+    for fmt in (TIME_FMT, "%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"):
+        try: dt = datetime.strptime(s, fmt)
+        except ValueError: continue
+        return int((dt - EPOCH).total_seconds())
+    raise RuntimeError("Failed to parse time: %s" % s)
+
+
+def to_datetime(t):
+    """Convert epoch seconds to naive UTC datetime."""
+
+    return EPOCH + timedelta(seconds=t)
+
+
+@lru_cache(maxsize=1 << 18)
+def parse_orbit_name(name):
+    """Return OrbitName for orbit filename or ID, or None if it doesn't match."""
+
+    m = ORBIT_NAME_RE.search(name)
+    if m is None: return None
+    return OrbitName(m.group('sat'), m.group('type'), parse_time(m.group('cr')),
+                     parse_time(m.group('vs')), parse_time(m.group('ve')))
+
+
+@lru_cache(maxsize=1 << 18)
+def parse_cal_name(name):
+    """Return CalName for calibration filename or ID, or None if it doesn't match."""
+
+    m = CAL_NAME_RE.search(name)
+    if m is None: return None
+    return CalName(m.group('sat'), m.group('type'), parse_time(m.group('vs')),
+                   parse_time(m.group('cr')))